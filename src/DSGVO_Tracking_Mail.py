@@ -24,16 +24,25 @@ __license__ = "see LICENSE file"
 #  OTHER DEALINGS IN THE SOFTWARE.
 #
 
+import argparse
+import asyncio
+import hashlib
 import logging
+import signal
 import sys
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from csv import reader
+from functools import partial
+from itertools import islice
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
 import yaml
 
 from src.classes import *
+from src.Validator_Classes import EmailField
 
 see__version__ = "v.2.0.0"
 
@@ -41,6 +50,8 @@ SCRIPT_DIR = Path(sys.argv[0]).resolve().parent
 
 # instantiate logger outside so that is it available everywhere
 logger = logging.getLogger(__name__)
+# metrics of the current run, written by write_metrics
+metrics = Metrics(('fetched', 'dropped_whitelist', 'dropped_spf', 'unknown_alias', 'sent', 'failed'))
 
 
 def create_logging(config):
@@ -78,42 +89,171 @@ def create_logging(config):
     return logger
 
 
-def import_new_aliases(import_file, db_con):
+def file_fingerprint(import_file):
+    """
+    identifies the content of an import file by its size and a hash of its first 64 KiB
+    Args:
+        import_file (Path): location of the import file
+
+    Returns:
+        fingerprint (str): size and sha1 hash
+
+    """
+    with import_file.open('rb') as file:
+        head = file.read(65536)
+    return '{0}:{1}'.format(import_file.stat().st_size, hashlib.sha1(head).hexdigest())
+
+
+def read_chunks(file, chunk_size):
+    """
+    reads a csv file opened in binary mode chunk by chunk, starting at the current position. Chunks always end
+    after a complete row, a quoted field containing line breaks is never split across two chunks
+    Args:
+        file: file object opened with 'rb'
+        chunk_size (int): max number of rows per chunk
+
+    Yields:
+        rows, offset: parsed rows of the chunk and the position in bytes after its last row
+
+    """
+    def lines():
+        # the csv reader requests one line at a time, so file.tell() is the end of the last row read
+        first = file.tell() == 0
+        while line := file.readline():
+            line = line.decode('utf-8', errors='replace')
+            if first:
+                # byte order mark of files exported with Excel
+                line = line.lstrip('\ufeff')
+                first = False
+            yield line
+
+    rows = reader(lines())
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk, file.tell()
+
+
+def import_new_aliases(import_file, db_con, chunk_size=10000):
     """
     Imports data from csv file into DB.
     Sample data:
     foo@foobar.com,firstname.secondname@domain.com
     The current date (yyyy-mm-dd) will be added as 3rd value
+    The file is read in chunks of chunk_size rows, so that memory usage doesn't depend on the size of the file.
+    Each chunk is stored in one transaction together with the position in the file. If the import is interrupted,
+    the next one continues after the last stored chunk
     Args:
         import_file (Path): location of the import file
         db_con : db handler
+        chunk_size (int): (optional) number of rows per transaction
 
     Returns:
 
     """
     logger.debug('Aliases werden zur DB hinzugefügt')
-    with import_file.open('r') as file:
-        line = reader(file)
-        # import the alias entries from - date will always be the current one
-        counter = 0
-        for row in line:
-            try:
-                db_con.add_alias(row[0], row[1], date.today().strftime('%Y-%m-%d'))
-                counter += 1
-            except sqlite3.IntegrityError:
-                logger.error('Alias {0} existiert bereits in DB -> uebersprungen'.format(row[1]))
-        logger.debug('{0} Einträge zur DB hinzugefügt'.format(counter))
+    fingerprint = file_fingerprint(import_file)
+    offset = db_con.get_import_offset(import_file.name, fingerprint)
+    if offset:
+        logger.info('Import von {0} wird ab Byte {1} fortgesetzt'.format(import_file.name, offset))
+    today = date.today().strftime('%Y-%m-%d')
+    inserted = 0
+    invalid = 0
+    with import_file.open('rb') as file:
+        file.seek(offset)
+        for rows, offset in read_chunks(file, chunk_size):
+            valid_rows = []
+            for row in filter(None, rows):
+                row = [value.strip() for value in row]
+                if len(row) >= 2 and EmailField.is_email(row[0]) and EmailField.is_email(row[1]):
+                    valid_rows.append(row[:2])
+                else:
+                    invalid += 1
+                    logger.error('Zeile {0} ist ungültig -> uebersprungen'.format(','.join(row)))
+            # date will always be the current one
+            result = db_con.add_aliases_bulk(valid_rows, today, (import_file.name, fingerprint, offset))
+            for alias in result.skipped_aliases:
+                logger.error('Alias {0} existiert bereits in DB -> uebersprungen'.format(alias))
+            inserted += result.inserted
+    logger.debug('{0} Einträge zur DB hinzugefügt, {1} ungültige Zeilen'.format(inserted, invalid))
     # delete file
     import_file.unlink()
+    db_con.clear_import_checkpoint(import_file.name)
 
 
-def main():
+def passes_checks(message):
     """
-    Main function
+    runs whitelist and SPF check for a message
+    Args:
+        message (Message): message to be checked, headers only are sufficient
+
+    Returns:
+        passed (bool): True if the message passed both checks
+
+    """
+    logger.debug('Message {0}: Domain whitelisted: {1}; SPF OK: {2}'.format(
+            message.FROM_address, message.domain_whitelisted, message.spf_status))
+    if not message.domain_whitelisted:
+        metrics.count('dropped_whitelist')
+    elif not message.spf_status:
+        metrics.count('dropped_spf')
+    return message.domain_whitelisted and message.spf_status
+
+
+def check_message(message, db_con):
+    """
+    runs whitelist and SPF check for a message and looks up the real email address of its alias
+    Args:
+        message (Message): message to be checked, headers only are sufficient
+        db_con : db handler
+
+    Returns:
+        to_address (str): real email address or None if message shall not be forwarded
+
+    """
+    if not passes_checks(message):
+        return None
+    # if alias not found, skip this message
+    with metrics.timer('lookup'):
+        to_address = db_con.get_address(message.TO_address)
+    if not to_address:
+        metrics.count('unknown_alias')
+        logger.debug('keine E-Mail Adresse für Alias {0} in DB gefunden'.format(message.TO_address))
+    return to_address
+
+
+def resolve_aliases(candidates, db_con):
+    """
+    looks up the real email addresses of all candidates with a batch query
+    Args:
+        candidates (list): (msg_id, message) tuples of messages that passed the checks
+        db_con : db handler
+
+    Returns:
+        to_addresses (dict): msg_id and real email address, messages with an unknown alias are not included
+
+    """
+    with metrics.timer('lookup'):
+        addresses = db_con.get_addresses(message.TO_address for _, message in candidates)
+    to_addresses = {}
+    for msg_id, message in candidates:
+        to_address = addresses.get(message.TO_address)
+        if to_address:
+            to_addresses[msg_id] = to_address
+        else:
+            metrics.count('unknown_alias')
+            logger.debug('keine E-Mail Adresse für Alias {0} in DB gefunden'.format(message.TO_address))
+    return to_addresses
+
+
+def read_config(config_file):
+    """
+    reads the yaml config file and sets up logging and the class attributes of Message and IMAP_Class
+    Args:
+        config_file (Path): location of the config file
+
+    Returns:
+        config (dict): configuration
 
     """
-    # build path to config file
-    config_file = Path(SCRIPT_DIR, "config/config.yaml")
     with config_file.open('r') as file:
         # The FullLoader parameter handles the conversion from YAML
         # scalar values to Python the dictionary format
@@ -126,18 +266,9 @@ def main():
                config['LOGGING']['filecount']
                ]
 
-    logger = create_logging(logging)
+    create_logging(logging)
     logger.info('Programmstart Version {0}'.format(__version__))
 
-    from_addr = config['FORWARD']['from']
-
-    # check whether keys are present in yaml
-    if config['FORWARD'].get('bcc') is None:
-        bcc_addr = []
-    else:
-        # sanitize 'bcc' from None values
-        bcc_addr = list(filter(None, config['FORWARD']['bcc']))
-
     Message.check_spf = config['FORWARD']['SPFcheck']
 
     # check whether keys are present in yaml
@@ -146,123 +277,727 @@ def main():
     else:
         # sanitize from None values
         Message.whitelist = list(filter(None, config['WHITELIST'].get('allowed_domains')))
+    # compile the whitelist once
+    Message.whitelist_matcher()
 
+    IMAP_Class.retention_period = config['IMAP']['retention_period']
+    IMAP_Class.chunk_size = config['IMAP'].get('chunk_size', IMAP_Class.chunk_size)
+    IMAP_Class.trash_batch_size = config['IMAP'].get('trash_batch_size', IMAP_Class.trash_batch_size)
+
+    return config
+
+
+def open_database(config):
+    """
+    connects to the DB and imports new aliases
+    Args:
+        config (dict): configuration
+
+    Returns:
+        db_con (DBClass): db handler
+
+    """
     Path(config['SQLITE']['directory']).mkdir(parents=True, exist_ok=True)
     database = str(Path(config['SQLITE']['directory'], config['SQLITE']['dbname']).resolve())
 
     # connect to DB and import new aliases
-    db_con = DBClass(database, config['SQLITE']['table'], config['SQLITE']['retention_period'])
-    if Path(config['IMPORT']['directory'], config['IMPORT']['filename']).is_file():
-        import_file = Path(config['IMPORT']['directory'], config['IMPORT']['filename'])
-        import_new_aliases(import_file, db_con)
+    cache_config = config['SQLITE'].get('cache')
+    cache = AliasCache(cache_config.get('size', 10000), cache_config.get('ttl', 3600),
+                       cache_config.get('negative_ttl', 60)) if cache_config else None
+    db_con = DBClass(database, config['SQLITE']['table'], config['SQLITE']['retention_period'],
+                     config['SQLITE'].get('timeout', 5), config['SQLITE'].get('purge_batch_size', 0),
+                     config['SQLITE'].get('pragmas'), cache)
+    import_aliases(config, db_con)
+    return db_con
+
+
+def import_files(config):
+    """
+    returns the files of the import directory matching IMPORT.pattern and the file IMPORT.filename, the oldest first.
+    Files whose name starts with a dot are skipped, they are still being written
+    Args:
+        config (dict): configuration
+
+    Returns:
+        files (list): paths of the import files, sorted by modification time
+
+    """
+    directory = Path(config['IMPORT']['directory'])
+    patterns = {config['IMPORT'].get('pattern', '*.csv'), config['IMPORT'].get('filename') or ''} - {''}
+    files = {}
+    for pattern in patterns:
+        for import_file in directory.glob(pattern):
+            if import_file.name.startswith('.'):
+                continue
+            try:
+                if import_file.is_file():
+                    files[import_file] = (import_file.stat().st_mtime_ns, import_file.name)
+            except FileNotFoundError:
+                # deleted in the meantime
+                pass
+    return sorted(files, key=files.get)
 
-    imap_error = False
 
+def import_aliases(config, db_con):
+    """
+    imports new aliases from all files in the import directory in the order in which they have been written
+    Args:
+        config (dict): configuration
+        db_con (DBClass): db handler
+
+    Returns:
+        n/a
+
+    """
+    for import_file in import_files(config):
+        logger.info('Importdatei {0} wird verarbeitet'.format(import_file.name))
+        with metrics.timer('import'):
+            try:
+                import_new_aliases(import_file, db_con, config['IMPORT'].get('chunk_size', 10000))
+            except OSError as err:
+                # e.g. no permission to delete the file - the checkpoint is kept and the import retried next time
+                logger.error('Fehler beim Import von {0}: {1}'.format(import_file.name, err))
+
+
+def connect_imap(config):
+    """
+    opens an authenticated session to the imap server
+    Args:
+        config (dict): configuration
+
+    Returns:
+        imap_session (IMAP_Class): authenticated session or None if the connection failed
+
+    """
     try:
         logger.debug('Verbindung zum imap Server aufbauen')
-        imap_session = IMAP_Class(
-                config['IMAP']['username'], config['IMAP']['password'], config['IMAP']['host'], config['IMAP']['port'],
-                config['IMAP']['ssl'], config['IMAP']['tls']
-        )
-        imap_session.login()
-        IMAP_Class.retention_period = config['IMAP']['retention_period']
+        with metrics.timer('imap_login'):
+            imap_session = IMAP_Class(
+                    config['IMAP']['username'], config['IMAP']['password'], config['IMAP']['host'],
+                    config['IMAP']['port'], config['IMAP']['ssl'], config['IMAP']['tls']
+            )
+            imap_session.login()
+        return imap_session
     except TimeoutError as err:
         logger.error('Request timed out: %s' % err)
-        imap_error = True
 
     except OSError as err:
         logger.error('Host {0}:{1} not found: {2}'.format(config['IMAP']['host'], config['IMAP']['port'], err))
-        imap_error = True
 
     except imaplib.IMAP4.error as err:
         logger.error('IMAPClient.AbortError: %s' % err)
-        imap_error = True
 
     except Exception as err:
         logger.error('Unknown error: %s' % err)
         logger.error(traceback.format_exc())
-        imap_error = True
 
-    # terminate script if imap_error
-    if imap_error:
-        sys.exit(1)
+    return None
 
-    # fetch unseen emails
-    imap_session.folder('Inbox')
+
+def connect_smtp(config):
+    """
+    creates the pool of smtp sessions and authenticates the first one
+    Args:
+        config (dict): configuration
+
+    Returns:
+        smtp_pool (SMTP_Pool): pool of smtp sessions or None if the connection failed
+
+    """
     try:
-        msg_ids = imap_session.get_email_ids("NOT SEEN")
-        logger.debug('{0} neue E-Mails gefunden'.format(len(msg_ids)))
-    except imaplib.IMAP4.error as err:
-        logger.error(f"Fehler beim Lesen der E-Mails\n{err}\nProgramm wird beendet")
-        # terminate in case of exception
-        imap_session.quit()
-        sys.exit(1)
+        logger.debug('Verbindung zum smtp Server aufbauen')
+        smtp_pool = SMTP_Pool(
+                partial(SMTP_Class, config['SMTP']['username'], config['SMTP']['password'], config['SMTP']['host'],
+                        config['SMTP']['port'], config['SMTP']['ssl'], config['SMTP']['tls']),
+                config['SMTP'].get('pool_size', 1), config['SMTP'].get('max_messages_per_connection', 0),
+                config['SMTP'].get('keep_alive_interval', 60)
+        )
+        # authenticate once, the sessions are reused for all messages
+        with metrics.timer('smtp_login'):
+            smtp_pool.connect()
+        return smtp_pool
+    except (smtplib.SMTPException, OSError) as err:
+        logger.error(
+                'Fehler bei der Verbindung mit SMTP Server {0}:{1} - {2}'.format(
+                        config['SMTP']['host'], config['SMTP']['port'], err))
+        return None
 
-    # create list message instances from new emails
-    messages = []
-    for msg_id in msg_ids:
-        message = Message(imap_session.fetch_message_by_id(msg_id))
-        # get the real email address from DB based on "To" address, which is the alias from email
-        # and replace headers
-        # no need to further process this message if checks are not OK
-        logger.debug('Message {0}: Domain whitelisted: {1}; SPF OK: {2}'.format(
-                message.FROM_address, message.domain_whitelisted, message.spf_status))
-        if not message.domain_whitelisted or not message.spf_status:
-            continue
-        # if alias not found, skip this message
-        to_address = db_con.get_address(message.TO_address)
-        if not to_address:
-            logger.debug('keine E-Mail Adresse für Alias {0} in DB gefunden'.format(message.TO_address))
-            continue
-        message.TO_address = to_address
-        message.FROM_address = from_addr
-        message.BCC_address = bcc_addr
-        messages.append(message)
 
+def prepare_forward(message, to_address, config):
+    """
+    replaces the headers of a message so that it can be forwarded to the real email address
+    Args:
+        message (Message): message to be forwarded
+        to_address (str): real email address
+        config (dict): configuration
+
+    Returns:
+        n/a
+
+    """
+    # check whether keys are present in yaml
+    if config['FORWARD'].get('bcc') is None:
+        bcc_addr = []
+    else:
+        # sanitize 'bcc' from None values
+        bcc_addr = list(filter(None, config['FORWARD']['bcc']))
+
+    message.TO_address = to_address
+    message.FROM_address = config['FORWARD']['from']
+    message.BCC_address = bcc_addr
+
+
+def log_result(result):
+    """
+    logs the result of sending a message
+    Args:
+        result (SendResult): result of sending a message
+
+    Returns:
+        sent (bool): True if the message has been sent
+
+    """
+    if result.error is None:
+        metrics.count('sent')
+        logger.debug("E-Mail erfolgreich gesendet! {0}".format(result.recipients))
+        return True
+    metrics.count('failed')
+    logger.error("Fehler beim senden des E-Mails an {0}\n{1}".format(result.recipients, result.error))
+    return False
+
+
+def purge_old_entries(imap_session, db_con):
+    """
+    purges old emails and DB entries that are beyond retention period
+    Args:
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+
+    Returns:
+        n/a
+
+    """
     # purge old emails and close session
     # for an unknown reason sometines an EOF error ocurrs when searching for emails to be deleted.
     # as this is harmless (only mails will not be deleted) it is safe to continue
+    trahsed_messages = 0
+    with metrics.timer('purge'):
+        try:
+            trahsed_messages = imap_session.trash_mails()
+        except Exception as err:
+            logger.error('That damned EOF error has occurred again. When time permits, need to do RCA {0}'.format(
+                    err))
+        logger.debug('{0} E-Mails gelöscht'.format(trahsed_messages))
+        if 'UIDPLUS' not in imap_session.session.capabilities:
+            # with UIDPLUS the trashed messages have already been expunged, a plain EXPUNGE would also purge
+            # messages flagged as deleted by other clients
+            imap_session.empty_folder('INBOX')
+
+        # purge DB entries that are beyond retention period
+        aliases_purged = db_con.purge_old_entries()
+    logger.debug("{0} alte Einträge aus DB entfernt".format(aliases_purged))
+    if db_con.cache is not None:
+        logger.debug('Alias Cache: {0}'.format(db_con.cache.stats()))
+    if Message.whitelist_matcher() is not None:
+        # statistics since the last housekeeping
+        logger.debug('Whitelist: {0}'.format(Message.whitelist_matcher().stats(reset=True)))
+
+
+def write_metrics(config):
+    """
+    logs the metrics of the run, writes them to the files configured in METRICS and starts a new run
+    Args:
+        config (dict): configuration
+
+    Returns:
+        n/a
+
+    """
+    metrics_config = config.get('METRICS') or {}
+    logger.debug('Metriken: {0}'.format(metrics.summary()))
     try:
-        trahsed_messages = imap_session.trash_mails()
-    except Exception as err:
-        logger.error('That damned EOF error has occurred again. When time permits, need to do RCA {0}'.format(err))
-    logger.debug('{0} E-Mails gelöscht'.format(trahsed_messages))
-    imap_session.empty_folder('INBOX')
-    imap_session.quit()
+        if metrics_config.get('json_file'):
+            metrics.write_json(metrics_config['json_file'])
+        if metrics_config.get('prometheus_file'):
+            metrics.write_prometheus(metrics_config['prometheus_file'])
+    except OSError as err:
+        logger.error('Fehler beim Schreiben der Metriken: {0}'.format(err))
+    metrics.reset()
 
-    # purge DB entries that are beyond retention period
-    aliases_purged = db_con.purge_old_entries()
-    logger.debug("{0} alte Einträge aus DB entfernt".format(aliases_purged))
+
+def housekeeping(imap_session, db_con):
+    """
+    purges old emails and old DB entries and closes IMAP session and DB
+    Args:
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+
+    Returns:
+        n/a
+
+    """
+    purge_old_entries(imap_session, db_con)
+    imap_session.quit()
     db_con.close()
 
-    if not messages:
+
+def fetch_messages(imap_session, msg_ids, message_parts='(RFC822)'):
+    """
+    fetches messages and records the time and the volume in the metrics
+    Args:
+        imap_session (IMAP_Class): imap session
+        msg_ids (list): ids of the messages to be fetched
+        message_parts (str): (optional) message data items to be fetched
+
+    Yields:
+        (msg_id, data) (tuple): message id (bytes) and raw bytes of the message
+
+    """
+    for msg_id, raw_message in metrics.timed(imap_session.fetch_messages(msg_ids, message_parts), 'fetch'):
+        metrics.add_bytes('fetched', len(raw_message))
+        yield msg_id, raw_message
+
+
+def parse_message(raw_message):
+    """
+    parses a message and records the time in the metrics. The whitelist and SPF checks run while parsing
+    Args:
+        raw_message (bytes): message as fetched from the imap server
+
+    Returns:
+        message (LazyMessage): parsed message
+
+    """
+    with metrics.timer('parse'):
+        return LazyMessage(raw_message)
+
+
+def check_fetched(fetched, executor=None):
+    """
+    parses and checks fetched messages, either in this process or distributed to the worker processes of executor
+    Args:
+        fetched (iterable): (msg_id, raw message) tuples
+        executor (ProcessPoolExecutor): (optional) worker processes
+
+    Yields:
+        msg_id, raw_message, checked: checked is a LazyMessage or the CheckResult of a worker, both provide the
+        attributes used by passes_checks and resolve_aliases
+
+    """
+    if executor is None:
+        for msg_id, raw_message in fetched:
+            metrics.count('fetched')
+            yield msg_id, raw_message, parse_message(raw_message)
+    else:
+        # raw messages are kept here, the workers return the compact results only
+        raw_messages = dict(fetched)
+        metrics.count('fetched', len(raw_messages))
+        # the workers match with their own copy of the whitelist, the statistics are kept here
+        matcher = Message.whitelist_matcher()
+        for result in metrics.timed(executor.map(check_raw_message, raw_messages, raw_messages.values(),
+                                                 chunksize=16), 'parse'):
+            if matcher is not None:
+                matcher.record(result.FROM_address, result.domain_whitelisted)
+            yield result.msg_id, raw_messages[result.msg_id], result
+
+
+def get_new_ids(config, imap_session, db_con):
+    """
+    returns the ids of the messages to be processed. With IMAP.incremental these are the UIDs above the last
+    processed UID stored in the DB, otherwise the sequence numbers of the unseen messages
+    Args:
+        config (dict): configuration
+        imap_session (IMAP_Class): imap session, the folder has to be selected
+        db_con (DBClass): db handler
+
+    Returns:
+        msg_ids (list): ids of the new messages
+
+    """
+    with metrics.timer('search'):
+        if not config['IMAP'].get('incremental', False):
+            return imap_session.get_email_ids("NOT SEEN")
+        uidvalidity, last_uid = db_con.get_sync_state('INBOX') or (None, 0)
+        if uidvalidity != imap_session.uidvalidity:
+            logger.info('UIDVALIDITY {0} unbekannt, alle ungelesenen E-Mails werden verarbeitet'.format(
+                imap_session.uidvalidity))
+        return imap_session.get_new_uids(uidvalidity, last_uid)
+
+
+def save_sync_state(imap_session, db_con):
+    """
+    stores the UID of the last processed message for the incremental sync, nothing to do without IMAP.incremental
+    Args:
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+
+    Returns:
+        n/a
+
+    """
+    if imap_session.use_uid:
+        db_con.set_sync_state('INBOX', imap_session.uidvalidity, imap_session.high_water_mark)
+
+
+def collect_messages(config, imap_session, db_con, msg_ids, executor=None):
+    """
+    fetches and checks messages and prepares those to be forwarded
+    Args:
+        config (dict): configuration
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+        msg_ids (list): ids of the messages to be processed
+        executor (ProcessPoolExecutor): (optional) worker processes for parsing and checking
+
+    Returns:
+        messages (list): Message instances ready to be sent
+
+    """
+    header_prefilter = config['IMAP'].get('header_prefilter', False)
+    if header_prefilter:
+        # phase 1: read only the header fields needed for the checks, full messages are downloaded
+        # only for those that will actually be forwarded
+        candidates = []
+        for msg_id, _, checked in check_fetched(fetch_messages(imap_session, msg_ids, IMAP_Class.HEADER_FIELDS),
+                                                executor):
+            if passes_checks(checked):
+                candidates.append((msg_id, checked))
+        to_addresses = resolve_aliases(candidates, db_con)
+        # BODY.PEEK doesn't set the \Seen flag, dropped messages need to be flagged explicitly
+        imap_session.mark_seen([msg_id for msg_id in msg_ids if msg_id not in to_addresses])
+        logger.debug('{0} E-Mails nach Prüfung der Header weiterzuleiten'.format(len(to_addresses)))
+        # phase 2: download the full messages, the results of the checks of phase 1 are taken over
+        checked = dict(candidates)
+        candidates = [(msg_id, raw_message, LazyMessage(raw_message, checked[msg_id]))
+                      for msg_id, raw_message in fetch_messages(imap_session, list(to_addresses))]
+    else:
+        # check new emails, no need to further process a message if checks are not OK
+        candidates = []
+        for msg_id, raw_message, checked in check_fetched(fetch_messages(imap_session, msg_ids), executor):
+            if passes_checks(checked):
+                candidates.append((msg_id, raw_message, checked))
+        # get the real email addresses from DB based on "To" address, which is the alias from email
+        to_addresses = resolve_aliases([(msg_id, checked) for msg_id, _, checked in candidates], db_con)
+
+    # replace headers of the messages to be forwarded
+    messages = []
+    for msg_id, raw_message, checked in candidates:
+        if msg_id in to_addresses:
+            # the result of a worker process is turned into a message without checking it again
+            message = checked if isinstance(checked, LazyMessage) else LazyMessage(raw_message, checked)
+            prepare_forward(message, to_addresses[msg_id], config)
+            messages.append(message)
+    return messages
+
+
+def iter_messages(config, imap_session, db_con, msg_ids, executor=None):
+    """
+    fetches, checks and prepares the messages chunk by chunk (IMAP.chunk_size), so that only one chunk of messages
+    is held in memory regardless of the number of new emails
+    Args:
+        config (dict): configuration
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+        msg_ids (list): ids of the messages to be processed
+        executor (ProcessPoolExecutor): (optional) worker processes for parsing and checking
+
+    Yields:
+        message (LazyMessage): message ready to be sent
+
+    """
+    for i in range(0, len(msg_ids), IMAP_Class.chunk_size):
+        yield from collect_messages(config, imap_session, db_con, msg_ids[i:i + IMAP_Class.chunk_size], executor)
+
+
+def run_batch(config, imap_session, db_con, msg_ids, executor=None):
+    """
+    processes the messages as a stream (fetch -> check -> alias lookup -> send) in chunks, followed by housekeeping
+    Args:
+        config (dict): configuration
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+        msg_ids (list): ids of the messages to be processed
+        executor (ProcessPoolExecutor): (optional) worker processes for parsing and checking
+
+    Returns:
+        n/a
+
+    """
+    if msg_ids:
+        # connect before the messages are fetched - they stay unseen if the smtp server isn't available
+        smtp_pool = connect_smtp(config)
+        if smtp_pool is None:
+            imap_session.quit()
+            sys.exit(1)
+        send_messages(smtp_pool, iter_messages(config, imap_session, db_con, msg_ids, executor))
+        smtp_pool.quit()
+    else:
         logger.debug('keine Emails zu versenden')
-        sys.exit(0)
-    try:
-        logger.debug('Verbindung zum smtp Server aufbauen')
-        smtp_session = SMTP_Class(
-                config['SMTP']['username'], config['SMTP']['password'], config['SMTP']['host'], config['SMTP']['port'],
-                config['SMTP']['ssl'], config['SMTP']['tls']
-        )
-    except smtplib.SMTPException as err:
-        logger.error(
-                'Fehler bei der Verbindung mit SMTP Server {0}:{1} - {2}\nProgramm wird beendet'.format(
-                        config['SMTP']['host'], config['SMTP']['port'], err))
+
+    save_sync_state(imap_session, db_con)
+    housekeeping(imap_session, db_con)
+
+
+def send_messages(smtp_pool, messages):
+    """
+    sends messages with specified envelope from and to addresses via the pooled sessions
+    Args:
+        smtp_pool (SMTP_Pool): pool of smtp sessions
+        messages (iterable): Message instances ready to be sent
+
+    Returns:
+        n/a
+
+    """
+    sent_count = 0
+    count = 0
+    for result in smtp_pool.send_messages(messages):
+        sent_count += log_result(result)
+        count += 1
+    logger.debug('{0} von {1} E-Mails gesendet'.format(sent_count, count))
+
+
+async def run_pipeline(config, imap_session, db_con, msg_ids):
+    """
+    processes the messages in concurrent stages (fetch -> check and alias lookup -> send) that are connected by
+    bounded queues. A message is sent as soon as it has been checked and the queue sizes cap the memory usage.
+    Blocking IMAP and SMTP calls run in threads, checks and DB lookups in the event loop
+    Args:
+        config (dict): configuration
+        imap_session (IMAP_Class): imap session
+        db_con (DBClass): db handler
+        msg_ids (list): ids of the messages to be processed
+
+    Returns:
+        n/a
+
+    """
+    if not msg_ids:
+        logger.debug('keine Emails zu versenden')
+        return
+    smtp_pool = await asyncio.to_thread(connect_smtp, config)
+    if smtp_pool is None:
+        # same as the batch mode: the messages stay unseen, log out before terminating
+        close_imap(imap_session)
         sys.exit(1)
+    queue_size = (config.get('PIPELINE') or {}).get('queue_size', 100)
+    raw_messages = asyncio.Queue(queue_size)
+    messages = asyncio.Queue(queue_size)
+    sent_count = 0
+
+    async def fetch():
+        fetched = fetch_messages(imap_session, msg_ids)
+        while (item := await asyncio.to_thread(next, fetched, None)) is not None:
+            await raw_messages.put(item)
+        # end of stream
+        await raw_messages.put(None)
+
+    async def check():
+        while (item := await raw_messages.get()) is not None:
+            metrics.count('fetched')
+            message = parse_message(item[1])
+            to_address = check_message(message, db_con)
+            if to_address:
+                prepare_forward(message, to_address, config)
+                await messages.put(message)
+        # one end of stream marker per sender
+        for _ in range(smtp_pool.size):
+            await messages.put(None)
+
+    async def send():
+        nonlocal sent_count
+        while (message := await messages.get()) is not None:
+            sent_count += log_result(await asyncio.to_thread(smtp_pool.send, message))
+
+    stages = [asyncio.create_task(stage) for stage in (fetch(), check(), *(send() for _ in range(smtp_pool.size)))]
+    try:
+        await asyncio.gather(*stages)
+    except BaseException:
+        # a failed stage would leave the others waiting on a full or empty queue forever
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        raise
+    finally:
+        logger.debug('{0} E-Mails gesendet'.format(sent_count))
+        smtp_pool.quit()
+
+
+def close_imap(imap_session):
+    """
+    closes an imap session that might already have been dropped by the server
+    Args:
+        imap_session (IMAP_Class): session or None
+
+    Returns:
+        None
 
-    for message in messages:
-        # open authenticated SMTP connection and send message with
-        # specified envelope from and to addresses
+    """
+    if imap_session is not None:
         try:
-            smtp_session.login()
+            imap_session.quit()
+        except (imaplib.IMAP4.error, OSError):
+            # session might have been interrupted during IDLE
+            try:
+                imap_session.session.shutdown()
+            except OSError:
+                pass
+    return None
 
-            smtp_session.send_message(message.FROM_address, [message.TO_address] + message.BCC_address,
-                                      message.message_as_string)
-            logger.debug("E-Mail erfolgreich gesendet! {0}".format([message.TO_address] + message.BCC_address))
-        except Exception as err:
-            logger.error("Fehler beim senden des E-Mails\n{0}".format(err))
 
-    smtp_session.quit()
+def run_daemon(config, db_con, executor=None):
+    """
+    long running mode: keeps the imap session open and waits with IMAP IDLE for new messages instead of being
+    started periodically. DB and smtp sessions are reused across cycles, dropped connections are reestablished
+    Args:
+        config (dict): configuration
+        db_con (DBClass): db handler
+        executor (ProcessPoolExecutor): (optional) worker processes for parsing and checking
+
+    Returns:
+        n/a
+
+    """
+    daemon_config = config.get('DAEMON') or {}
+    idle_timeout = daemon_config.get('idle_timeout', 300)
+    reconnect_delay = daemon_config.get('reconnect_delay', 60)
+    housekeeping_interval = daemon_config.get('housekeeping_interval', 3600)
+
+    # new import files are picked up immediately instead of after the next idle timeout
+    watcher = DirectoryWatcher(config['IMPORT']['directory'], config['IMPORT'].get('pattern', '*.csv'),
+                               daemon_config.get('import_poll_interval', 1.0))
+    if watcher.fileno() is None:
+        logger.info('inotify nicht verfügbar, Importverzeichnis wird regelmäßig geprüft')
+    imap_session = None
+    smtp_pool = None
+    # housekeeping runs in the first cycle
+    last_housekeeping = float('-inf')
+    try:
+        while True:
+            try:
+                if imap_session is None:
+                    imap_session = connect_imap(config)
+                    if imap_session is None:
+                        time.sleep(reconnect_delay)
+                        continue
+                    imap_session.folder('Inbox')
+                import_aliases(config, db_con)
+                msg_ids = get_new_ids(config, imap_session, db_con)
+                logger.debug('{0} neue E-Mails gefunden'.format(len(msg_ids)))
+                if msg_ids:
+                    # connect before the messages are fetched - they stay unseen if the smtp server isn't available
+                    smtp_pool = smtp_pool or connect_smtp(config)
+                    if smtp_pool is not None:
+                        send_messages(smtp_pool, iter_messages(config, imap_session, db_con, msg_ids, executor))
+                        save_sync_state(imap_session, db_con)
+                else:
+                    save_sync_state(imap_session, db_con)
+                if time.monotonic() - last_housekeeping >= housekeeping_interval:
+                    purge_old_entries(imap_session, db_con)
+                    last_housekeeping = time.monotonic()
+                    write_metrics(config)
+                elif msg_ids:
+                    write_metrics(config)
+                imap_session.idle(idle_timeout, watcher)
+            except (imaplib.IMAP4.abort, OSError) as err:
+                logger.error('Verbindung zum imap Server verloren: {0}'.format(err))
+                imap_session = close_imap(imap_session)
+                time.sleep(reconnect_delay)
+            except imaplib.IMAP4.error as err:
+                # e.g. IDLE rejected or BAD response to SEARCH - a new session starts in a defined state
+                logger.error('Fehler des imap Servers, Verbindung wird neu aufgebaut: {0}'.format(err))
+                imap_session = close_imap(imap_session)
+                time.sleep(reconnect_delay)
+    finally:
+        watcher.close()
+        if smtp_pool is not None:
+            smtp_pool.quit()
+        close_imap(imap_session)
+        db_con.close()
+
+
+def run(config, db_con, args, executor=None):
+    """
+    single run: processes all unseen messages and terminates
+    Args:
+        config (dict): configuration
+        db_con (DBClass): db handler
+        args (argparse.Namespace): command line arguments
+        executor (ProcessPoolExecutor): (optional) worker processes for parsing and checking
+
+    Returns:
+        n/a
+
+    """
+    imap_session = connect_imap(config)
+    if imap_session is None:
+        # terminate script if imap_error
+        sys.exit(1)
+
+    # fetch unseen emails
+    imap_session.folder('Inbox')
+    try:
+        msg_ids = get_new_ids(config, imap_session, db_con)
+        logger.debug('{0} neue E-Mails gefunden'.format(len(msg_ids)))
+    except imaplib.IMAP4.error as err:
+        logger.error(f"Fehler beim Lesen der E-Mails\n{err}\nProgramm wird beendet")
+        # terminate in case of exception
+        imap_session.quit()
+        sys.exit(1)
+
+    if args.pipeline:
+        if config['IMAP'].get('header_prefilter', False):
+            logger.debug('header_prefilter wird im async Modus nicht verwendet')
+        if args.workers > 1:
+            logger.debug('--workers wird im async Modus nicht verwendet')
+        asyncio.run(run_pipeline(config, imap_session, db_con, msg_ids))
+        save_sync_state(imap_session, db_con)
+        housekeeping(imap_session, db_con)
+    else:
+        run_batch(config, imap_session, db_con, msg_ids, executor)
+    write_metrics(config)
+
+
+def main(args=None):
+    """
+    Main function
+    Args:
+        args (list): (optional) command line arguments, defaults to sys.argv
+
+    """
+    parser = argparse.ArgumentParser(description='Leitet Versandbenachrichtigungen an die echte E-Mail-Adresse weiter')
+    parser.add_argument('--async', dest='pipeline', action='store_true',
+                        help='Abruf, Prüfung und Versand der E-Mails überlappend ausführen')
+    parser.add_argument('--daemon', action='store_true',
+                        help='dauerhaft laufen und mit IMAP IDLE auf neue E-Mails warten')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='E-Mails mit N Prozessen parsen und prüfen (Standard: 1)')
+    # build path to config file
+    parser.add_argument('--config', type=Path, default=Path(SCRIPT_DIR, "config/config.yaml"),
+                        help='Pfad zur Konfigurationsdatei (Standard: config/config.yaml im Verzeichnis des Skripts)')
+    args = parser.parse_args(args)
+
+    with metrics.timer('config'):
+        config = read_config(args.config)
+    SMTP_Pool.metrics = metrics
+    db_con = open_database(config)
+    executor = None
+    if args.workers > 1 and not args.pipeline:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                       initargs=(Message.check_spf, Message.whitelist))
+    try:
+        if args.daemon:
+            # SIGTERM (e.g. systemctl stop) terminates the daemon the same way as Ctrl-C
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            try:
+                run_daemon(config, db_con, executor)
+            except KeyboardInterrupt:
+                logger.info('Programm beendet')
+            return
+        run(config, db_con, args, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
 if __name__ == '__main__':
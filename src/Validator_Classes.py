@@ -235,3 +235,40 @@ class IPv4Field(BaseValidator):
         """
         if not IPv4Field.is_ipv4(value):
             raise ValueError(f'{self.prop_name} must be a valid IPv4 address.')
+
+
+class EmailField(BaseValidator):
+    """
+    validates that value is a valid email address
+    """
+
+    def __init__(self):
+        super().__init__()
+
+    @staticmethod
+    def is_email(value):
+        """
+        returns True if value is a plausible email address: a local part without spaces and a FQDN with at least
+        two labels, e.g. noreply@dhl.de
+
+        """
+        if not isinstance(value, str) or not 3 <= len(value) <= 254:
+            return False
+        local_part, at, domain = value.rpartition('@')
+        if not at or not local_part or len(local_part) > 64 or any(char.isspace() for char in local_part):
+            return False
+        return '.' in domain.rstrip('.') and FQDNField.is_fqdn(domain)
+
+    def validate(self, value):
+        """
+        validates the value
+        Args:
+            value: value that is subjected to validation
+
+        Returns:
+
+        Raises:
+            ValueError: if conditions are not met
+        """
+        if not EmailField.is_email(value):
+            raise ValueError(f'{self.prop_name} must be a valid email address.')
@@ -27,17 +27,42 @@ __license__ = "see LICENSE file"
 #  OTHER DEALINGS IN THE SOFTWARE.
 #  """
 
+import ctypes
 import email
 import imaplib
+import json
+import os
+import queue
 import re
+import select
 import smtplib
+import socket
 import sqlite3
+import ssl
+import struct
+import sys
+import threading
+import time
 
 from src.Validator_Classes import CharField, IntegerField, BoolField, FQDNField
 
-from email.parser import HeaderParser
+from collections import Counter, deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.header import Header
+from email.parser import BytesHeaderParser
+from email.utils import formataddr, parseaddr
+from fnmatch import fnmatch
+from pathlib import Path
 from datetime import datetime, timedelta, date
 
+# result of sending one message: error is None if the message was sent successfully
+SendResult = namedtuple('SendResult', ['message', 'recipients', 'error'])
+# result of a bulk import of aliases
+ImportResult = namedtuple('ImportResult', ['inserted', 'skipped', 'skipped_aliases'])
+# result of checking a message in a worker process, attribute names match those of Message used by the checks
+CheckResult = namedtuple('CheckResult', ['msg_id', 'FROM_address', 'TO_address', 'domain_whitelisted', 'spf_status'])
+
 
 class MailHost:
     """
@@ -68,6 +93,21 @@ class IMAP_Class(MailHost):
     this class connects to an IMAP server and provides several methods to read, delete etc. messages
     """
     retention_period = IntegerField(0, 99)
+    # max number of message ids that are requested with a single FETCH/STORE command
+    chunk_size = 500
+    # max number of message ids that are flagged as deleted with a single STORE command
+    trash_batch_size = 1000
+    # header fields needed to decide whether a message is forwarded. BODY.PEEK does not set the \Seen flag
+    HEADER_FIELDS = '(BODY.PEEK[HEADER.FIELDS (FROM TO RECEIVED-SPF)])'
+    # message ids are UIDs instead of sequence numbers, set by get_new_uids
+    use_uid = False
+    # UIDVALIDITY and UIDNEXT of the selected folder
+    uidvalidity = None
+    uidnext = None
+    # highest UID that has been returned by get_new_uids
+    high_water_mark = 0
+    # UID of a message in a UID FETCH response
+    UID_PATTERN = re.compile(rb'\bUID (\d+)')
 
     def __init__(self, username, password, host=None, port=143, ssl=False, tls=False):
         super().__init__(username, password)
@@ -87,11 +127,16 @@ class IMAP_Class(MailHost):
 
     def login(self):
         """
-        this method logs into the IMAP server with given credentials
+        this method logs into the IMAP server with given credentials. The capabilities are requested again
+        afterwards, many servers (e.g. Dovecot, Gmail) advertise extensions like UIDPLUS only after authentication
         Returns:
 
         """
         _, ddata = self.session.login(self.username, self.password)
+        typ, data = self.session.capability()
+        if typ == 'OK' and data and data[-1]:
+            # same format as imaplib stores the capabilities sent before login
+            self.session.capabilities = tuple(data[-1].decode('ascii', 'replace').upper().split())
 
     def folder(self, folder):
         """
@@ -104,6 +149,10 @@ class IMAP_Class(MailHost):
 
         """
         self.session.select(folder)
+        uidvalidity = self.session.response('UIDVALIDITY')[1][0]
+        uidnext = self.session.response('UIDNEXT')[1][0]
+        self.uidvalidity = int(uidvalidity) if uidvalidity else None
+        self.uidnext = int(uidnext) if uidnext else None
 
     def empty_folder(self, folder):
         """
@@ -118,19 +167,37 @@ class IMAP_Class(MailHost):
         self.folder(folder)
         self.session.expunge()
 
-    def trash_mails(self):
+    def trash_mails(self, batch_size=None):
         """
-        trashs all emails older than retention_preiod
+        trashs all emails older than retention_preiod. The messages are flagged in batches with compressed sequence
+        sets. If the server supports UIDPLUS (RFC 4315), UIDs are used and the flagged messages are expunged right
+        away with UID EXPUNGE, which leaves messages flagged as deleted by other clients untouched. Otherwise they are
+        only flagged and have to be purged with empty_folder
+        Args:
+            batch_size (int): (optional) max number of ids per STORE command. Defaults to cls attribute
+            trash_batch_size
+
         Returns:
             len(msg_ids) (int): number of trashed emails
 
         """
+        batch_size = batch_size or IMAP_Class.trash_batch_size
         before_date = (date.today() - timedelta(days=IMAP_Class.retention_period)).strftime("%d-%b-%Y")
-        _, data = self.session.search(None, '(BEFORE "{0}")'.format(before_date))
+        criterion = '(BEFORE "{0}")'.format(before_date)
+        use_uid = 'UIDPLUS' in self.session.capabilities
+        if use_uid:
+            _, data = self.session.uid('SEARCH', criterion)
+        else:
+            _, data = self.session.search(None, criterion)
 
         msg_ids = data[0].split()
-        for msg_id in msg_ids:
-            self.session.store(msg_id, '+FLAGS', '\\Deleted')  # move to trash
+        for i in range(0, len(msg_ids), batch_size):
+            message_set = IMAP_Class.sequence_set(msg_ids[i:i + batch_size])
+            if use_uid:
+                self.session.uid('STORE', message_set, '+FLAGS', '\\Deleted')
+                self.session.uid('EXPUNGE', message_set)
+            else:
+                self.session.store(message_set, '+FLAGS', '\\Deleted')  # move to trash
         return len(msg_ids)
 
     def get_email_ids(self, criterion):
@@ -146,6 +213,39 @@ class IMAP_Class(MailHost):
         _, msg_ids = self.session.search(None, '{0}'.format(criterion))
         return msg_ids[0].split()
 
+    def get_new_uids(self, uidvalidity=None, last_uid=0):
+        """
+        incremental sync: returns the UIDs of the messages that have arrived after last_uid, no matter whether they
+        have been read by another client. If uidvalidity doesn't match the selected folder (e.g. first run or the
+        folder has been recreated) a full resync with the unseen messages is done. Switches the instance to UIDs
+        for fetch_messages and mark_seen
+        Args:
+            uidvalidity (int): (optional) UIDVALIDITY the last_uid belongs to
+            last_uid (int): (optional) last processed UID
+
+        Returns:
+            uids (list): UIDs (bytes) of the new messages. The new high-water mark is stored in high_water_mark
+
+        """
+        self.use_uid = True
+        if uidvalidity is None or uidvalidity != self.uidvalidity:
+            _, data = self.session.uid('SEARCH', 'NOT SEEN')
+            uids = data[0].split()
+            # messages older than UIDNEXT have been seen already
+            if self.uidnext is not None:
+                self.high_water_mark = self.uidnext - 1
+            else:
+                # the server didn't send UIDNEXT: take the highest UID in the folder instead
+                _, data = self.session.uid('SEARCH', 'ALL')
+                self.high_water_mark = max([0] + [int(uid) for uid in data[0].split()])
+        else:
+            _, data = self.session.uid('SEARCH', 'UID {0}:*'.format(last_uid + 1))
+            # n:* always contains the message with the highest UID, even if it is below n
+            uids = [uid for uid in data[0].split() if int(uid) > last_uid]
+            self.high_water_mark = last_uid
+        self.high_water_mark = max([self.high_water_mark] + [int(uid) for uid in uids])
+        return uids
+
     def fetch_message_by_id(self, msg_id):
         """
         reads and returns message  based on id from server
@@ -158,6 +258,177 @@ class IMAP_Class(MailHost):
         _, data = self.session.fetch(msg_id, "(RFC822)")
         return data[0][1]
 
+    @staticmethod
+    def message_set(msg_ids):
+        """
+        builds an IMAP message set from a list of message ids
+        Args:
+            msg_ids (list): message ids (bytes, str or int)
+
+        Returns:
+            message_set (str): comma separated message ids, e.g. '1,2,5'
+
+        """
+        return ','.join(msg_id.decode() if isinstance(msg_id, bytes) else str(msg_id) for msg_id in msg_ids)
+
+    @staticmethod
+    def sequence_set(msg_ids):
+        """
+        builds a compressed IMAP sequence set from a list of message ids, consecutive ids are combined to a range
+        Args:
+            msg_ids (list): message ids (bytes, str or int)
+
+        Returns:
+            sequence_set (str): sorted ids and ranges, e.g. '1:200,205,300:450'
+
+        """
+        ranges = []
+        for msg_id in sorted({int(msg_id) for msg_id in msg_ids}):
+            if ranges and msg_id == ranges[-1][1] + 1:
+                ranges[-1][1] = msg_id
+            else:
+                ranges.append([msg_id, msg_id])
+        return ','.join(str(first) if first == last else '{0}:{1}'.format(first, last) for first, last in ranges)
+
+    def fetch_messages(self, msg_ids, message_parts='(RFC822)', chunk_size=None):
+        """
+        reads messages in batches from server - one FETCH command per chunk instead of one per message
+        Args:
+            msg_ids (list): message ids as returned by get_email_ids
+            message_parts (str): (optional) message data items to be fetched
+            chunk_size (int): (optional) max number of ids per FETCH command. Defaults to cls attribute chunk_size
+
+        Yields:
+            (msg_id, data) (tuple): message id (bytes) and raw bytes of the message
+
+        """
+        chunk_size = chunk_size or IMAP_Class.chunk_size
+        for i in range(0, len(msg_ids), chunk_size):
+            message_set = IMAP_Class.message_set(msg_ids[i:i + chunk_size])
+            if self.use_uid:
+                _, data = self.session.uid('FETCH', message_set, message_parts)
+            else:
+                _, data = self.session.fetch(message_set, message_parts)
+            pending = None
+            for item in data:
+                # each message is returned as tuple (b'<id> (RFC822 {<size>}', b'<raw message>'),
+                # the closing parenthesis follows as separate bytes object
+                if isinstance(item, tuple):
+                    if not self.use_uid:
+                        yield item[0].split(b' ', 1)[0], item[1]
+                    elif uid := IMAP_Class.UID_PATTERN.search(item[0]):
+                        yield uid.group(1), item[1]
+                    else:
+                        # UID follows the message, e.g. b' UID 4711)'
+                        pending = item[1]
+                elif pending is not None and (uid := IMAP_Class.UID_PATTERN.search(item)):
+                    yield uid.group(1), pending
+                    pending = None
+
+    def mark_seen(self, msg_ids, chunk_size=None):
+        """
+        sets the \\Seen flag for messages, e.g. for those which were only read with BODY.PEEK
+        Args:
+            msg_ids (list): message ids as returned by get_email_ids
+            chunk_size (int): (optional) max number of ids per STORE command. Defaults to cls attribute chunk_size
+
+        Returns:
+            n/a
+
+        """
+        chunk_size = chunk_size or IMAP_Class.chunk_size
+        for i in range(0, len(msg_ids), chunk_size):
+            if self.use_uid:
+                self.session.uid('STORE', IMAP_Class.message_set(msg_ids[i:i + chunk_size]), '+FLAGS', '\\Seen')
+            else:
+                self.session.store(IMAP_Class.message_set(msg_ids[i:i + chunk_size]), '+FLAGS', '\\Seen')
+
+    def noop(self):
+        """
+        sends NOOP, keeps the session alive and raises imaplib.IMAP4.abort if the connection has been dropped
+        Returns:
+            n/a
+
+        """
+        self.session.noop()
+
+    def idle(self, timeout=300, watcher=None):
+        """
+        waits until the server reports a new message (IMAP IDLE, RFC 2177) or timeout has elapsed.
+        If the server doesn't support IDLE, it waits for timeout and sends NOOP instead
+        Args:
+            timeout (int): max number of seconds to wait, must be below 29 minutes according to RFC 2177
+            watcher (DirectoryWatcher): (optional) stops waiting as soon as a new file shows up in its directory
+
+        Returns:
+            new_mail (bool): True if the server has reported a new message, always True for the NOOP fallback
+
+        """
+        if 'IDLE' not in self.session.capabilities:
+            if watcher is None:
+                time.sleep(timeout)
+            else:
+                watcher.wait(timeout)
+            self.noop()
+            return True
+
+        tag = self.session._new_tag()
+        try:
+            self.session.send(tag + b' IDLE\r\n')
+            response = self.session.readline()
+            if not response.startswith(b'+'):
+                raise imaplib.IMAP4.error('IDLE rejected: {0}'.format(response.decode(errors='replace').strip()))
+
+            new_mail = False
+            deadline = time.monotonic() + timeout
+            try:
+                while not new_mail and (remaining := deadline - time.monotonic()) > 0:
+                    if watcher is not None and not self._pending():
+                        fd = watcher.fileno()
+                        if fd is None:
+                            ready = select.select([self.session.sock], [], [], min(remaining, watcher.poll_interval))[0]
+                        else:
+                            ready = select.select([self.session.sock, fd], [], [], remaining)[0]
+                        if (fd is None or fd in ready) and watcher.changed():
+                            break
+                        if self.session.sock not in ready:
+                            continue
+                    self.session.sock.settimeout(remaining)
+                    line = self.session.readline()
+                    if not line:
+                        raise imaplib.IMAP4.abort('connection closed during IDLE')
+                    # e.g. b'* 23 EXISTS'
+                    new_mail = line.startswith(b'*') and line.rstrip().endswith((b'EXISTS', b'RECENT'))
+            except socket.timeout:
+                # a file object that has run into a timeout can't be read anymore
+                self.session.file = self.session.sock.makefile('rb')
+            finally:
+                self.session.sock.settimeout(None)
+
+            self.session.send(b'DONE\r\n')
+            while not (line := self.session.readline()).startswith(tag):
+                if not line:
+                    raise imaplib.IMAP4.abort('connection closed during IDLE')
+            return new_mail
+        finally:
+            # _new_tag registers the tag, imaplib only removes the tags of the responses it reads itself
+            self.session.tagged_commands.pop(tag, None)
+
+    def _pending(self):
+        """
+        checks without blocking whether a response of the server is buffered or waiting on the socket
+        Returns:
+            pending (bool): True if a response can be read
+
+        """
+        self.session.sock.settimeout(0)
+        try:
+            return bool(self.session.file.peek(1))
+        except ssl.SSLWantReadError:
+            return False
+        finally:
+            self.session.sock.settimeout(None)
+
     def quit(self):
         """
         close and release session
@@ -168,19 +439,134 @@ class IMAP_Class(MailHost):
         self.session.logout()
 
 
-class Message:
+class WhitelistMatcher:
     """
-    class that holds an email message
+    matches sender domains against the domain whitelist. Exact domains are kept in a set, rules like *.dhl.de are
+    kept in a trie of reversed domain labels (de -> dhl) and match every subdomain of dhl.de, but not dhl.de itself
     """
-    check_spf = False
-    whitelist = []
-    SPF_CODES = ["pass", "Pass", "softfail", "SoftFail", "neutral", "Neutral", "none", "None"]
+    # marks the end of a suffix rule in the trie
+    _END = object()
 
-    def __init__(self, message):
-        self.message = email.message_from_bytes(message)
-        self.bcc = []
-        self._spf_check()
-        self._whitelist_check()
+    def __init__(self, domains):
+        """
+        Args:
+            domains (list): allowed domains, either exact (dhl.de) or suffix rules (*.dhl.de)
+        """
+        self.domains = list(domains)
+        self._exact = set()
+        self._suffixes = {}
+        for domain in self.domains:
+            domain = domain.strip().lower().rstrip('.')
+            if domain.startswith('*.'):
+                node = self._suffixes
+                for label in reversed(domain[2:].split('.')):
+                    node = node.setdefault(label, {})
+                node[WhitelistMatcher._END] = '*.' + domain[2:]
+            elif domain:
+                self._exact.add(domain)
+        self.matches = Counter()
+        self.rejects = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_domain(from_address):
+        """
+        extracts the domain of the address in a From header
+        Args:
+            from_address (str): From header, e.g. DHL <noreply@dhl.de>
+
+        Returns:
+            domain (str): domain in lower case, e.g. dhl.de, None if there is no address
+
+        """
+        address = parseaddr(str(from_address or ''))[1]
+        local_part, at, domain = address.rpartition('@')
+        if not at or not local_part or not domain:
+            return None
+        return domain.lower().rstrip('.')
+
+    def _rule(self, domain):
+        """
+        returns the rule a domain is matched by
+        Args:
+            domain (str): domain in lower case
+
+        Returns:
+            rule (str): matching whitelist entry or None
+
+        """
+        if domain in self._exact:
+            return domain
+        node = self._suffixes
+        labels = domain.split('.')
+        # the last label has to remain as subdomain
+        for label in reversed(labels[1:]):
+            node = node.get(label)
+            if node is None:
+                return None
+            if WhitelistMatcher._END in node:
+                return node[WhitelistMatcher._END]
+        return None
+
+    def match(self, from_address):
+        """
+        checks whether the sender domain of a From header is whitelisted
+        Args:
+            from_address (str): From header
+
+        Returns:
+            whitelisted (bool): True if the domain matches one of the rules
+
+        """
+        domain = WhitelistMatcher.get_domain(from_address)
+        whitelisted = domain is not None and self._rule(domain) is not None
+        self.record(from_address, whitelisted, domain)
+        return whitelisted
+
+    def record(self, from_address, whitelisted, domain=None):
+        """
+        adds a result to the match statistics, e.g. a result of a worker process whose matcher isn't visible here
+        Args:
+            from_address (str): From header
+            whitelisted (bool): result of the whitelist check
+            domain (str): (optional) sender domain if already known
+
+        Returns:
+            n/a
+
+        """
+        domain = domain or WhitelistMatcher.get_domain(from_address)
+        with self._lock:
+            if whitelisted:
+                self.matches[domain] += 1
+            else:
+                self.rejects[domain] += 1
+
+    def stats(self, reset=False):
+        """
+        returns the match statistics
+        Args:
+            reset (bool): (optional) starts new statistics, so that a long running process doesn't collect every
+                          spam domain ever seen
+
+        Returns:
+            stats (dict): number of matched and rejected messages per sender domain, None for missing addresses
+
+        """
+        with self._lock:
+            stats = {'matches': dict(self.matches), 'rejects': dict(self.rejects)}
+            if reset:
+                self.matches.clear()
+                self.rejects.clear()
+            return stats
+
+
+class MessageBase:
+    """
+    checks and header access shared by Message and LazyMessage. Subclasses provide the parsed headers in attribute
+    headers, the configuration is read from the cls attributes of Message
+    """
+    __slots__ = ()
 
     def _spf_check(self):
         """
@@ -191,13 +577,27 @@ class Message:
 
         """
         if Message.check_spf:
-            parser = HeaderParser()
-            headers = parser.parsestr(self.message_as_string)
-            received_spf = headers.get('Received-SPF')
-            self._spf_status = any(code in received_spf for code in Message.SPF_CODES)
+            self._spf_status = Message.spf_passed(self.headers.get_all('Received-SPF'))
         else:
             self._spf_status = True
 
+    @staticmethod
+    def spf_passed(received_spf):
+        """
+        evaluates the Received-SPF headers of a message. Only the topmost header is relevant as it has been added by
+        the own mail server, further ones may have been added (or forged) before. A missing header counts as passed
+        Args:
+            received_spf (list): values of all Received-SPF headers in the order of the message or None
+
+        Returns:
+            passed (bool): True if the result (first word of the header) is one of SPF_CODES
+
+        """
+        if not received_spf or not str(received_spf[0]).split():
+            return True
+        result = str(received_spf[0]).split(None, 1)[0]
+        return result.lower() in (code.lower() for code in Message.SPF_CODES)
+
     @staticmethod
     def get_domain(from_address):
         """
@@ -205,8 +605,23 @@ class Message:
         :param from_address: zB noreply@dhl.de
         :return: dhl.de
         """
-        # return only the domain part
-        return re.findall(r'@([a-zA-Z0-9][\w\.-]*[a-zA-Z0-9]\.[a-zA-Z][a-zA-Z\.]*[a-zA-Z])', from_address)[0]
+        return WhitelistMatcher.get_domain(from_address)
+
+    @staticmethod
+    def whitelist_matcher():
+        """
+        returns the matcher for the cls attribute whitelist of Message. It is compiled once and again only if a new
+        list has been assigned to Message.whitelist
+        Returns:
+            matcher (WhitelistMatcher): matcher or None if the whitelist is empty
+
+        """
+        if not Message.whitelist:
+            return None
+        if Message._matcher is None or Message._matcher_source is not Message.whitelist:
+            Message._matcher = WhitelistMatcher(Message.whitelist)
+            Message._matcher_source = Message.whitelist
+        return Message._matcher
 
     def _whitelist_check(self):
         """
@@ -215,17 +630,12 @@ class Message:
             n/a
 
         """
+        matcher = Message.whitelist_matcher()
         # if whiteliste is empty set status to true
-        if not Message.whitelist:
+        if matcher is None:
             self._domain_whitelisted = True
         else:
-            # nur die Domain ist relevant
-            domain = Message.get_domain(self.message['From'])
-
-            if domain in Message.whitelist:
-                self._domain_whitelisted = True
-            else:
-                self._domain_whitelisted = False
+            self._domain_whitelisted = matcher.match(self.headers['From'])
 
     @property
     def TO_address(self):
@@ -235,7 +645,7 @@ class Message:
             To (str): 'To' address
 
         """
-        return self.message['To']
+        return self.headers['To']
 
     @TO_address.setter
     def TO_address(self, addr):
@@ -248,7 +658,7 @@ class Message:
             n/a
 
         """
-        self.message.replace_header("To", addr)
+        self.headers.replace_header("To", addr)
 
     @property
     def FROM_address(self):
@@ -258,7 +668,7 @@ class Message:
             From (str): 'From' address
 
         """
-        return self.message['From']
+        return self.headers['From']
 
     @FROM_address.setter
     def FROM_address(self, addr):
@@ -271,7 +681,7 @@ class Message:
             n/a
 
         """
-        self.message.replace_header("FROM", addr)
+        self.headers.replace_header("FROM", addr)
 
     @property
     def BCC_address(self) -> list:
@@ -318,6 +728,108 @@ class Message:
         """
         return self._domain_whitelisted
 
+
+class Message(MessageBase):
+    """
+    class that holds an email message
+    """
+    check_spf = False
+    whitelist = []
+    _matcher = None
+    _matcher_source = None
+    SPF_CODES = ["pass", "Pass", "softfail", "SoftFail", "neutral", "Neutral", "none", "None"]
+
+    def __init__(self, message):
+        self.message = email.message_from_bytes(message)
+        self.bcc = []
+        self._spf_check()
+        self._whitelist_check()
+
+    @property
+    def headers(self):
+        """
+        returns the parsed message, which holds the headers as well
+        Returns:
+            message (email.message.Message): parsed message
+
+        """
+        return self.message
+
+    @property
+    def message_as_string(self):
+        """
+        return message as a string so that it can be sent via smtp
+        Returns:
+
+        """
+        return self.message.as_string()
+
+    @property
+    def message_as_bytes(self):
+        """
+        return message as bytes so that it can be sent via smtp. smtplib passes bytes unchanged, so the lines end
+        with CRLF as required by RFC 5322
+        Returns:
+
+        """
+        return self.message.as_bytes(policy=self.message.policy.clone(linesep='\r\n'))
+
+
+class LazyMessage(MessageBase):
+    """
+    class that holds an email message of which only the header block is parsed up front. The MIME tree is built
+    only when the message is actually forwarded, messages dropped by the checks never get that far
+    """
+    __slots__ = ('raw', 'headers', 'bcc', '_message', '_spf_status', '_domain_whitelisted')
+
+    def __init__(self, message, checked=None):
+        """
+        Args:
+            message (bytes): raw message
+            checked: (optional) result of the checks done before for this message, e.g. the CheckResult of a worker
+                     process. Its domain_whitelisted and spf_status are taken over instead of checking again
+        """
+        self.raw = message
+        self.headers = BytesHeaderParser().parsebytes(LazyMessage.header_block(message))
+        self.bcc = []
+        self._message = None
+        if checked is None:
+            self._spf_check()
+            self._whitelist_check()
+        else:
+            self._spf_status = checked.spf_status
+            self._domain_whitelisted = checked.domain_whitelisted
+
+    @staticmethod
+    def header_block(message):
+        """
+        returns the header block of a raw message without the body
+        Args:
+            message (bytes): raw message
+
+        Returns:
+            header_block (bytes): headers including the terminating empty line
+
+        """
+        end = min((pos + len(separator) for separator in (b'\r\n\r\n', b'\n\n')
+                   if (pos := message.find(separator)) >= 0), default=len(message))
+        return message[:end]
+
+    @property
+    def message(self):
+        """
+        returns the complete parsed message, it is parsed on first access. Changed headers are applied
+        Returns:
+            message (email.message.Message): parsed message
+
+        """
+        if self._message is None:
+            self._message = email.message_from_bytes(self.raw)
+        for field in ('To', 'From'):
+            if self.headers[field] is not None and self._message[field] != self.headers[field]:
+                self._message.replace_header(field, self.headers[field])
+        return self._message
+
     @property
     def message_as_string(self):
         """
@@ -327,10 +839,97 @@ class Message:
         """
         return self.message.as_string()
 
+    @property
+    def message_as_bytes(self):
+        """
+        return the raw message with the current To and From headers so that it can be sent via smtp. Only these
+        header lines are rewritten, all other headers and the body are passed through untouched - nothing is
+        regenerated, re-folded or re-encoded
+        Returns:
+            message (bytes): raw message
+
+        """
+        header_end = len(LazyMessage.header_block(self.raw))
+        fields = {'to': 'To', 'from': 'From'}
+        lines = []
+        replaced = False
+        for line in self.raw[:header_end].splitlines(keepends=True):
+            if line[:1] in (b' ', b'\t'):
+                # continuation line of a folded header
+                if not replaced:
+                    lines.append(line)
+                continue
+            field = fields.get(line.split(b':', 1)[0].strip().lower().decode('ascii', 'replace'))
+            replaced = field is not None and self.headers[field] is not None
+            if replaced:
+                value = str(self.headers[field])
+                eol = b'\r\n' if line.endswith(b'\r\n') else b'\n'
+                if not value.isascii():
+                    # long values are folded with the line ending of the message
+                    value = LazyMessage.encode_address(value, field, eol.decode())
+                lines.append(f'{field}: {value}'.encode('ascii') + eol)
+            else:
+                lines.append(line)
+        lines.append(memoryview(self.raw)[header_end:])
+        return b''.join(lines)
+
+    @staticmethod
+    def encode_address(value, field='From', linesep='\r\n'):
+        """
+        encodes the display name of an address according to RFC 2047, the address itself has to stay readable
+        Args:
+            value (str): address, e.g. Müller Versand <versand@example.de>
+            field (str): (optional) name of the header field, it counts for the length of the first line
+            linesep (str): (optional) line ending used to fold long names
+
+        Returns:
+            value (str): ascii only address, e.g. =?utf-8?q?M=C3=BCller_Versand?= <versand@example.de>
+
+        """
+        name, address = parseaddr(value)
+        if not address or not address.isascii():
+            # internationalized address - can only be transported encoded as a whole
+            return Header(value, 'utf-8', header_name=field).encode(linesep=linesep)
+        if not name:
+            return address
+        return formataddr((Header(name, 'utf-8', header_name=field).encode(linesep=linesep), address))
+
+
+def init_worker(check_spf, whitelist):
+    """
+    initializes a worker process of the check pool with the configuration of the main process
+    Args:
+        check_spf (bool): value of Message.check_spf
+        whitelist (list): value of Message.whitelist
+
+    Returns:
+        n/a
+
+    """
+    Message.check_spf = check_spf
+    Message.whitelist = whitelist
+
+
+def check_raw_message(msg_id, raw_message):
+    """
+    parses and checks a message in a worker process. Only the compact result is sent back, the raw message stays
+    with the caller
+    Args:
+        msg_id (bytes): id of the message
+        raw_message (bytes): message as fetched from the imap server
+
+    Returns:
+        result (CheckResult): addresses and results of the checks
+
+    """
+    message = LazyMessage(raw_message)
+    return CheckResult(msg_id, message.FROM_address, message.TO_address, message.domain_whitelisted,
+                       message.spf_status)
+
 
 class SMTP_Class(MailHost):
     """
-    class that holds session to a smtp server
+    class that holds session to a smtp server. The session is authenticated only once and reused for all messages
     """
 
     def __init__(self, username, password, host=None, port=None, ssl=False, tls=False):
@@ -342,6 +941,17 @@ class SMTP_Class(MailHost):
         self.ssl = ssl
         self.tls = tls
         self.session = None
+        self.sent_count = 0
+        self._logged_in = False
+        self.connect()
+
+    def connect(self):
+        """
+        opens a new connection to the smtp server, an existing session is discarded
+        Returns:
+            n/a
+
+        """
         if self.ssl:
             self.session = smtplib.SMTP_SSL(self.host, self.port)
         else:
@@ -350,19 +960,49 @@ class SMTP_Class(MailHost):
             # tls_context = ssl.create_default_context()
             # imap_session.starttls(ssl_context=tls_context)
             self.session.starttls()
+        self._logged_in = False
 
     def login(self):
         """
-        logs into a smtp server
+        logs into a smtp server. Nothing is done if the session is already authenticated
         Returns:
             n/a
 
         """
+        if self._logged_in:
+            return
         self.session.login(self.username, self.password)
+        self._logged_in = True
+
+    def reset(self):
+        """
+        aborts the current mail transaction, e.g. after a failed message, so that the session can be reused
+        Returns:
+            n/a
+
+        """
+        try:
+            self.session.rset()
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+
+    def keep_alive(self):
+        """
+        sends NOOP to keep an idle session alive and reconnects if the server has closed the connection
+        Returns:
+            n/a
+
+        """
+        try:
+            self.session.noop()
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.login()
 
     def send_message(self, from_address, to_address, message):
         """
-        sends an email message
+        sends an email message. If the server has closed the connection in the meantime, the session is
+        reestablished and the message sent once again
         Args:
             from_address: email addres the message is sent from
             to_address: email addres the message is sent to
@@ -371,7 +1011,14 @@ class SMTP_Class(MailHost):
         Returns:
 
         """
-        self.session.sendmail(from_address, to_address, message)
+        self.login()
+        try:
+            self.session.sendmail(from_address, to_address, message)
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.login()
+            self.session.sendmail(from_address, to_address, message)
+        self.sent_count += 1
 
     def quit(self):
         """
@@ -379,29 +1026,328 @@ class SMTP_Class(MailHost):
         Returns:
 
         """
-        self.session.quit()
+        try:
+            self.session.quit()
+        except smtplib.SMTPServerDisconnected:
+            # connection already closed by server
+            pass
+        self._logged_in = False
 
 
-class DBClass:
+class SMTP_Pool:
     """
-    class that hold connection to a sqlite DB
+    bounded pool of authenticated SMTP_Class sessions that are shared by several threads
     """
-    def __init__(self, database: str, table: str, retention_period=30, timeout=5):
+    # Metrics instance to record the time and bytes of sending, None disables it
+    metrics = None
+
+    def __init__(self, factory, size=1, max_messages=0, keep_alive_interval=60):
         """
-        - connects to a sqlite DB
-        - creates the DB file if it doesn't exist
+        Args:
+            factory: callable that returns a new (not yet authenticated) SMTP_Class instance
+            size (int): max number of concurrently opened sessions
+            max_messages (int): (optional) max number of messages per session before it is replaced
+                                by a new one, 0 means no limit
+            keep_alive_interval (float): (optional) a session that has been idle for at least this number of seconds
+                                         is checked with NOOP before it is used again
+        """
+        if size < 1:
+            raise ValueError(f'{size} must be >= 1.')
+        self.factory = factory
+        self.size = size
+        self.max_messages = max_messages
+        self.keep_alive_interval = keep_alive_interval
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    def connect(self):
+        """
+        opens and authenticates the first session so that connection problems show up before any message is sent
+        Returns:
+            n/a
+
+        """
+        with self.session():
+            pass
+
+    @contextmanager
+    def session(self):
+        """
+        context manager that lends an authenticated session from the pool. A new session is opened if no idle
+        one is available and less than size sessions are in use. Sessions that have been idle for a longer time, e.g.
+        between two cycles of the daemon, are checked with NOOP and reconnected if the server has closed them
+        Yields:
+            smtp_session (SMTP_Class): authenticated session
+
+        """
+        with self._slots:
+            try:
+                smtp_session, idle_since = self._idle.get_nowait()
+                if time.monotonic() - idle_since >= self.keep_alive_interval:
+                    smtp_session.keep_alive()
+            except queue.Empty:
+                smtp_session = self.factory()
+                smtp_session.login()
+            try:
+                yield smtp_session
+            except Exception:
+                # clear the failed transaction before the session is reused
+                smtp_session.reset()
+                raise
+            finally:
+                if self.max_messages and smtp_session.sent_count >= self.max_messages:
+                    smtp_session.quit()
+                else:
+                    self._idle.put((smtp_session, time.monotonic()))
+
+    def send(self, message):
+        """
+        sends a single message with a pooled session
+        Args:
+            message (Message): message to be sent
+
+        Returns:
+            result (SendResult): result for this message
+
+        """
+        recipients = [message.TO_address] + message.BCC_address
+        start = time.perf_counter()
+        try:
+            message_bytes = message.message_as_bytes
+            with self.session() as smtp_session:
+                smtp_session.send_message(message.FROM_address, recipients, message_bytes)
+        except Exception as err:
+            return SendResult(message, recipients, err)
+        finally:
+            if SMTP_Pool.metrics is not None:
+                SMTP_Pool.metrics.add_time('send', time.perf_counter() - start)
+        if SMTP_Pool.metrics is not None:
+            SMTP_Pool.metrics.add_bytes('sent', len(message_bytes))
+        return SendResult(message, recipients, None)
+
+    def send_messages(self, messages):
+        """
+        sends messages in parallel, one thread per pooled session. messages is consumed lazily, at most two
+        messages per session are in flight, so a generator of messages is never read ahead completely
+        Args:
+            messages (iterable): Message instances to be sent
+
+        Yields:
+            result (SendResult): one result per message in the order of messages
+
+        """
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            pending = deque()
+            for message in messages:
+                pending.append(executor.submit(self.send, message))
+                if len(pending) >= 2 * self.size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def quit(self):
+        """
+        terminates all idle sessions
+        Returns:
+
+        """
+        while True:
+            try:
+                self._idle.get_nowait()[0].quit()
+            except queue.Empty:
+                break
+
+
+class AliasCache:
+    """
+    bounded LRU cache with time to live for alias lookups. Unknown aliases are cached as well (negative caching)
+    with a shorter time to live, so that newly imported aliases show up soon even without invalidation
+    """
+    # returned by get() if alias is not in cache
+    MISSING = object()
+
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=60, clock=time.monotonic):
+        """
+        Args:
+            max_size (int): max number of cached aliases, the least recently used one is evicted first
+            ttl (int): seconds a found address is cached
+            negative_ttl (int): seconds an unknown alias is cached
+            clock: (optional) function returning the current time in seconds
+        """
+        if max_size < 1:
+            raise ValueError(f'{max_size} must be >= 1.')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, alias):
+        """
+        returns the cached address of an alias
+        Args:
+            alias (str): alias to search for
+
+        Returns:
+            address (str): cached address, None for a cached unknown alias or MISSING if not cached or expired
+
+        """
+        key = alias.lower()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return AliasCache.MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, alias, address):
+        """
+        caches the address of an alias
+        Args:
+            alias (str): alias
+            address (str): address or None if alias is unknown
+
+        Returns:
+            n/a
+
+        """
+        expires = self.clock() + (self.ttl if address is not None else self.negative_ttl)
+        with self._lock:
+            self._entries[alias.lower()] = (expires, address)
+            self._entries.move_to_end(alias.lower())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, alias=None):
+        """
+        removes an alias or all aliases from the cache
+        Args:
+            alias (str): (optional) alias to be removed, all aliases are removed if None
+
+        Returns:
+            n/a
+
+        """
+        with self._lock:
+            if alias is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(alias.lower(), None)
+
+    def stats(self):
+        """
+        returns the cache statistics
+        Returns:
+            stats (dict): size, hits, misses and evictions
+
+        """
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class DBClass:
+    """
+    class that hold connection to a sqlite DB
+    """
+    # max number of aliases per query in get_addresses, below SQLITE_MAX_VARIABLE_NUMBER of older SQLite versions
+    MAX_VARIABLES = 900
+    # pragmas that can be set via config
+    PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout', 'temp_store')
+
+    def __init__(self, database: str, table: str, retention_period=30, timeout=5, purge_batch_size=0,
+                 pragmas=None, cache=None):
+        """
+        - connects to a sqlite DB
+        - creates the DB file if it doesn't exist
         - creates table is it doesn't exist
+        - migrates tables of older versions to a case-insensitive primary key
         Args:
             database: path + name of DB
             table: name of table
             timeout: (optional) connection timeout
+            purge_batch_size: (optional) max number of rows deleted per transaction by purge_old_entries,
+                              0 means all at once
+            pragmas: (optional) dict of pragmas applied after connecting, e.g. {'journal_mode': 'WAL'}
+            cache: (optional) AliasCache for get_address
         """
         self.table = table
+        self.cache = cache
         self. conn = sqlite3.connect(database, timeout)
+        try:
+            self._set_pragmas(pragmas or {})
+        except ValueError:
+            self.conn.close()
+            raise
+        self._migrate()
         with self.conn:
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS alias (email text, alias text primary key, 
-            date date_column)''')
+            self._create_table()
         self.rentention_period = retention_period
+        self.purge_batch_size = purge_batch_size
+
+    def _set_pragmas(self, pragmas):
+        """
+        applies pragmas to the connection
+        Args:
+            pragmas (dict): pragma name and value
+
+        Returns:
+            n/a
+        Raises:
+            ValueError: if the pragma is not supported or the value is invalid
+
+        """
+        for name, value in pragmas.items():
+            if name not in DBClass.PRAGMAS:
+                raise ValueError(f'pragma {name} not supported, must be one of {DBClass.PRAGMAS}')
+            if not re.fullmatch(r'-?\w+', str(value)):
+                raise ValueError(f'{value} is not a valid value for pragma {name}')
+            self.conn.execute(f'PRAGMA {name} = {value}')
+
+    def _create_table(self):
+        """
+        creates the alias table. The primary key uses COLLATE NOCASE so that the case-insensitive lookup of an
+        alias is an index search instead of a full table scan, the index on date turns the purge into a range scan
+        Returns:
+            n/a
+
+        """
+        self.conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (email text, 
+            alias text primary key COLLATE NOCASE, date date_column)''')
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_date ON {self.table} (date)')
+        self.conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.table}_sync (mailbox text primary key, 
+            uidvalidity integer, last_uid integer)''')
+        self.conn.execute(f'''CREATE TABLE IF NOT EXISTS {self.table}_import (file text primary key, 
+            fingerprint text, offset integer)''')
+
+    def _migrate(self):
+        """
+        rebuilds a table created by an older version with a case sensitive (BINARY) primary key on alias.
+        Aliases that only differ in case are merged, the first one is kept
+        Returns:
+            n/a
+
+        """
+        row = self.conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?",
+                                (self.table,)).fetchone()
+        if row is None or 'NOCASE' in row[0].upper():
+            return
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute(f'ALTER TABLE {self.table} RENAME TO {self.table}_old')
+            self._create_table()
+            self.conn.execute(f'''INSERT OR IGNORE INTO {self.table} (email, alias, date) 
+                SELECT email, alias, date FROM {self.table}_old ORDER BY rowid''')
+            self.conn.execute(f'DROP TABLE {self.table}_old')
 
     @staticmethod
     def validate(date):
@@ -436,7 +1382,106 @@ class DBClass:
         """
         DBClass.validate(date)
         with self.conn:
-            self.conn.execute(f'''INSERT INTO {self.table} VALUES('{address}', '{alias}', '{date}')''')
+            self.conn.execute(f'INSERT INTO {self.table} VALUES(?, ?, ?)', (address, alias, date))
+        if self.cache is not None:
+            self.cache.invalidate(alias)
+
+    def add_aliases_bulk(self, rows, date: str, checkpoint=None) -> ImportResult:
+        """
+        adds many aliases within one transaction. The rows are streamed into a temporary staging table with
+        executemany and inserted with ON CONFLICT DO NOTHING, aliases that already exist (also within rows) are
+        skipped
+        Args:
+            rows (iterable): rows of [address, alias], e.g. a csv.reader. Rows with less than 2 values are ignored
+            date (str): date the aliases were added
+            checkpoint (tuple): (optional) (file, fingerprint, offset) of an import file, stored in the same
+                                transaction so that an interrupted import can be resumed at offset
+
+        Returns:
+            result (ImportResult): number of inserted and skipped rows and the list of skipped aliases
+
+        """
+        DBClass.validate(date)
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS import_staging (email text, alias text COLLATE NOCASE)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS temp.import_staging_alias ON import_staging (alias)')
+            self.conn.execute('DELETE FROM temp.import_staging')
+            self.conn.executemany('INSERT INTO temp.import_staging VALUES(?, ?)',
+                                  (row[:2] for row in rows if len(row) >= 2))
+            skipped_aliases = [row[0] for row in self.conn.execute(f'''SELECT s.alias FROM temp.import_staging s 
+                WHERE EXISTS (SELECT 1 FROM {self.table} t WHERE t.alias = s.alias) 
+                OR EXISTS (SELECT 1 FROM temp.import_staging d WHERE d.alias = s.alias AND d.rowid < s.rowid) 
+                ORDER BY s.rowid''')]
+            cursor = self.conn.execute(f'''INSERT INTO {self.table} (email, alias, date) 
+                SELECT email, alias, ? FROM temp.import_staging WHERE true ORDER BY rowid 
+                ON CONFLICT DO NOTHING''', (date,))
+            inserted = cursor.rowcount
+            self.conn.execute('DELETE FROM temp.import_staging')
+            if checkpoint is not None:
+                self.conn.execute(f'INSERT OR REPLACE INTO {self.table}_import VALUES(?, ?, ?)', checkpoint)
+        if self.cache is not None and inserted:
+            # new aliases might be cached as unknown
+            self.cache.invalidate()
+        return ImportResult(inserted, len(skipped_aliases), skipped_aliases)
+
+    def get_import_offset(self, file: str, fingerprint: str) -> int:
+        """
+        returns the offset at which an interrupted import of a file has to be resumed
+        Args:
+            file (str): name of the import file
+            fingerprint (str): fingerprint of the content, a checkpoint of a different file with the same name is
+                               ignored
+
+        Returns:
+            offset (int): position in bytes up to which the file has been imported, 0 if there is no checkpoint
+
+        """
+        row = self.conn.execute(f'SELECT fingerprint, offset FROM {self.table}_import WHERE file = ?',
+                                (file,)).fetchone()
+        return row[1] if row and row[0] == fingerprint else 0
+
+    def clear_import_checkpoint(self, file: str):
+        """
+        removes the checkpoint of a completely imported file
+        Args:
+            file (str): name of the import file
+
+        Returns:
+            n/a
+
+        """
+        with self.conn:
+            self.conn.execute(f'DELETE FROM {self.table}_import WHERE file = ?', (file,))
+
+    def get_sync_state(self, mailbox: str):
+        """
+        returns the state of the incremental sync of a mailbox
+        Args:
+            mailbox (str): name of the mailbox
+
+        Returns:
+            (uidvalidity, last_uid) (tuple): UIDVALIDITY and last processed UID, None if no state has been stored
+
+        """
+        return self.conn.execute(f'SELECT uidvalidity, last_uid FROM {self.table}_sync WHERE mailbox = ?',
+                                 (mailbox,)).fetchone()
+
+    def set_sync_state(self, mailbox: str, uidvalidity: int, last_uid: int):
+        """
+        stores the state of the incremental sync of a mailbox
+        Args:
+            mailbox (str): name of the mailbox
+            uidvalidity (int): UIDVALIDITY of the mailbox
+            last_uid (int): last processed UID
+
+        Returns:
+            n/a
+
+        """
+        with self.conn:
+            self.conn.execute(f'INSERT OR REPLACE INTO {self.table}_sync VALUES(?, ?, ?)',
+                              (mailbox, uidvalidity, last_uid))
 
     def get_address(self, alias: str) -> str:
         """
@@ -448,31 +1493,81 @@ class DBClass:
             address (str): real email address-, the one the email will be sent to
 
         """
+        if self.cache is not None:
+            address = self.cache.get(alias)
+            if address is not AliasCache.MISSING:
+                return address
         c = self.conn.cursor()
-        c.execute(f'''SELECT * FROM {self.table} WHERE alias='{alias}' COLLATE NOCASE;''')
+        c.execute(f'SELECT email FROM {self.table} WHERE alias = ?', (alias,))
         row = c.fetchone()
-        return row[0] if row else None
+        address = row[0] if row else None
+        if self.cache is not None:
+            self.cache.put(alias, address)
+        return address
 
-    def purge_old_entries(self):
+    def get_addresses(self, aliases) -> dict:
         """
-        method will delete entrie older than retention
+        method returns the email addresses for many aliases with one query per MAX_VARIABLES aliases
         Args:
+            aliases (iterable): aliases to search for, None values are ignored
 
         Returns:
-            deleted_rows (int): returns the number of deleted rows
+            addresses (dict): alias (as given) and real email address, aliases not found are not included
 
         """
-        cursor = self.conn.cursor()
-        cursor.execute(f'''SELECT * FROM {self.table}''')
-        row_count = len(cursor.fetchall())
-        with self.conn:
-            self.conn.execute(f'''DELETE FROM {self.table} WHERE date <= date("now", "-{self.rentention_period} day")''')
+        aliases = {alias for alias in aliases if alias is not None}
+        addresses = {}
+        if self.cache is not None:
+            for alias in list(aliases):
+                address = self.cache.get(alias)
+                if address is not AliasCache.MISSING:
+                    aliases.discard(alias)
+                    if address is not None:
+                        addresses[alias] = address
+
+        aliases = list(aliases)
+        found = {}
+        for i in range(0, len(aliases), DBClass.MAX_VARIABLES):
+            chunk = aliases[i:i + DBClass.MAX_VARIABLES]
+            rows = self.conn.execute(f'SELECT alias, email FROM {self.table} WHERE alias IN '
+                                     f'({", ".join("?" * len(chunk))})', chunk)
+            found.update((alias.lower(), address) for alias, address in rows)
+        for alias in aliases:
+            address = found.get(alias.lower())
+            if self.cache is not None:
+                self.cache.put(alias, address)
+            if address is not None:
+                addresses[alias] = address
+        return addresses
 
-        cursor = self.conn.cursor()
-        cursor.execute(f'''SELECT * FROM {self.table}''')
-        new_row_count = len(cursor.fetchall())
-        deleted_rows = row_count - new_row_count
+    def purge_old_entries(self):
+        """
+        method will delete entrie older than retention. If purge_batch_size is set, the rows are deleted in
+        batches with one transaction each so that the write lock is released in between
+        Args:
 
+        Returns:
+            deleted_rows (int): returns the number of deleted rows
+
+        """
+        modifier = f'-{self.rentention_period} day'
+        if not self.purge_batch_size:
+            with self.conn:
+                cursor = self.conn.execute(f'DELETE FROM {self.table} WHERE date <= date("now", ?)', (modifier,))
+            deleted_rows = cursor.rowcount
+        else:
+            deleted_rows = 0
+            while True:
+                with self.conn:
+                    cursor = self.conn.execute(f'''DELETE FROM {self.table} WHERE rowid IN 
+                        (SELECT rowid FROM {self.table} WHERE date <= date("now", ?) LIMIT ?)''',
+                                               (modifier, self.purge_batch_size))
+                deleted_rows += cursor.rowcount
+                if cursor.rowcount < self.purge_batch_size:
+                    break
+
+        if self.cache is not None and deleted_rows:
+            self.cache.invalidate()
         return deleted_rows
 
     def commit(self):
@@ -485,13 +1580,333 @@ class DBClass:
 
     def close(self):
         """
-        closes connection
+        closes connection. In WAL mode the WAL file is written back into the DB and truncated before
         Returns:
 
         """
+        if self.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         self.conn.close()
 
 
+class Metrics:
+    """
+    collects the timers per stage, counters and byte volumes of a run. Timers add up the time of all threads, so a
+    stage that runs in parallel can take longer than the whole run
+    """
+
+    def __init__(self, counters=(), clock=time.perf_counter):
+        """
+        Args:
+            counters: (optional) names of counters that are reported even if they have not been incremented
+            clock: (optional) function returning the current time in seconds
+        """
+        self.counter_names = tuple(counters)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        starts a new run
+        Returns:
+            n/a
+
+        """
+        with self._lock:
+            self.started = datetime.now()
+            self._start = self.clock()
+            self.timers = {}
+            self.counters = dict.fromkeys(self.counter_names, 0)
+            self.volumes = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        context manager that adds the time spent within to stage
+        Args:
+            stage (str): name of the stage
+
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(stage, self.clock() - start)
+
+    def timed(self, iterable, stage):
+        """
+        passes the items of iterable through and adds the time spent to produce them to stage, e.g. for a
+        generator that fetches messages
+        Args:
+            iterable (iterable): items to be passed through
+            stage (str): name of the stage
+
+        Yields:
+            item: next item of iterable
+
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_time(self, stage, seconds):
+        """
+        adds time to a stage
+        Args:
+            stage (str): name of the stage
+            seconds (float): time to be added
+
+        Returns:
+            n/a
+
+        """
+        with self._lock:
+            self.timers[stage] = self.timers.get(stage, 0) + seconds
+
+    def count(self, name, value=1):
+        """
+        increments a counter
+        Args:
+            name (str): name of the counter
+            value (int): (optional) increment
+
+        Returns:
+            n/a
+
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_bytes(self, name, value):
+        """
+        adds to a byte volume
+        Args:
+            name (str): name of the volume, e.g. fetched
+            value (int): number of bytes
+
+        Returns:
+            n/a
+
+        """
+        with self._lock:
+            self.volumes[name] = self.volumes.get(name, 0) + value
+
+    def summary(self):
+        """
+        returns the metrics of the run
+        Returns:
+            summary (dict): start time, duration, timers (seconds), counters and byte volumes
+
+        """
+        with self._lock:
+            return {'started': self.started.isoformat(timespec='seconds'),
+                    'duration': round(self.clock() - self._start, 6),
+                    'timers': {stage: round(seconds, 6) for stage, seconds in self.timers.items()},
+                    'counters': dict(self.counters),
+                    'bytes': dict(self.volumes)}
+
+    def write_json(self, path):
+        """
+        appends the summary as one line of JSON to a file
+        Args:
+            path (str): path + name of the file
+
+        Returns:
+            n/a
+
+        """
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(self.summary()) + '\n')
+
+    def write_prometheus(self, path, prefix='dsgvo_tracking_mail'):
+        """
+        writes the summary in the Prometheus text format, e.g. for the textfile collector of node_exporter. The file
+        is replaced atomically so that the collector never reads a partly written file
+        Args:
+            path (str): path + name of the file, must end with .prom for node_exporter
+            prefix (str): (optional) prefix of the metric names
+
+        Returns:
+            n/a
+
+        """
+        summary = self.summary()
+        lines = [f'# HELP {prefix}_last_run_timestamp_seconds start time of the last run',
+                 f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                 f'{prefix}_last_run_timestamp_seconds {self.started.timestamp()}',
+                 f'# HELP {prefix}_last_run_duration_seconds duration of the last run',
+                 f'# TYPE {prefix}_last_run_duration_seconds gauge',
+                 f'{prefix}_last_run_duration_seconds {summary["duration"]}',
+                 f'# HELP {prefix}_stage_seconds time spent per stage in the last run',
+                 f'# TYPE {prefix}_stage_seconds gauge']
+        lines += [f'{prefix}_stage_seconds{{stage="{stage}"}} {seconds}'
+                  for stage, seconds in summary['timers'].items()]
+        lines += [f'# HELP {prefix}_messages number of messages per result in the last run',
+                  f'# TYPE {prefix}_messages gauge']
+        lines += [f'{prefix}_messages{{result="{name}"}} {value}' for name, value in summary['counters'].items()]
+        lines += [f'# HELP {prefix}_bytes bytes transferred in the last run',
+                  f'# TYPE {prefix}_bytes gauge']
+        lines += [f'{prefix}_bytes{{direction="{name}"}} {value}' for name, value in summary['bytes'].items()]
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+
+class DirectoryWatcher:
+    """
+    watches a directory for new files matching a pattern. On Linux inotify is used, so that a new file is noticed
+    immediately, otherwise the directory is polled every poll_interval seconds. Files whose name starts with a dot
+    are ignored, they are expected to be renamed once they have been written completely
+    """
+    # a file has been closed after writing or has been moved into the directory
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    # struct inotify_event without the name
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory, pattern='*.csv', poll_interval=1.0, use_inotify=True):
+        """
+        Args:
+            directory (str): directory to be watched
+            pattern (str): (optional) shell pattern of the file names
+            poll_interval (float): (optional) seconds between two scans if inotify isn't available
+            use_inotify (bool): (optional) False always polls the directory
+
+        """
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.fd = self._inotify() if use_inotify else None
+        self.snapshot = self._scan()
+
+    def _inotify(self):
+        """
+        creates an inotify instance watching the directory
+        Returns:
+            fd (int): non blocking file descriptor of the inotify instance, None if inotify isn't available
+
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def matches(self, name):
+        """
+        checks a file name against the pattern, names starting with a dot never match
+        Args:
+            name (str): file name without directory
+
+        Returns:
+            match (bool): True if the file has to be imported
+
+        """
+        return not name.startswith('.') and fnmatch(name, self.pattern)
+
+    def _scan(self):
+        """
+        lists the matching files of the directory
+        Returns:
+            snapshot (dict): modification time in ns per file name, empty if the directory doesn't exist
+
+        """
+        snapshot = {}
+        try:
+            for entry in os.scandir(self.directory):
+                if self.matches(entry.name):
+                    try:
+                        snapshot[entry.name] = entry.stat().st_mtime_ns
+                    except FileNotFoundError:
+                        # deleted in the meantime
+                        pass
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def fileno(self):
+        """
+        file descriptor to wait for with select
+        Returns:
+            fd (int): inotify file descriptor, None if the directory is polled
+
+        """
+        return self.fd
+
+    def changed(self):
+        """
+        checks without blocking whether a matching file has been written since the last call
+        Returns:
+            changed (bool): True if there is a new or modified file
+
+        """
+        if self.fd is None:
+            snapshot = self._scan()
+            changed = any(self.snapshot.get(name) != mtime for name, mtime in snapshot.items())
+            self.snapshot = snapshot
+            return changed
+
+        names = []
+        try:
+            while data := os.read(self.fd, 65536):
+                position = 0
+                while position < len(data):
+                    _, _, _, length = self.EVENT.unpack_from(data, position)
+                    position += self.EVENT.size
+                    names.append(os.fsdecode(data[position:position + length].rstrip(b'\0')))
+                    position += length
+        except BlockingIOError:
+            # all events have been read
+            pass
+        return any(self.matches(name) for name in names)
+
+    def wait(self, timeout):
+        """
+        waits until a matching file has been written or timeout has elapsed
+        Args:
+            timeout (float): max number of seconds to wait
+
+        Returns:
+            changed (bool): True if there is a new or modified file
+
+        """
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if self.fd is None:
+                time.sleep(min(remaining, self.poll_interval))
+            else:
+                select.select([self.fd], [], [], remaining)
+            if self.changed():
+                return True
+        return False
+
+    def close(self):
+        """
+        releases the inotify instance
+        Returns:
+            n/a
+
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 def main(args=None):
     """
     main function
@@ -507,3 +1922,4 @@ def main(args=None):
 if __name__ == "__main__":
 
     main()
+
@@ -0,0 +1,179 @@
+"""
+Project: TrackingMailProvider
+Filename: bench_db.py
+Description
+
+micro benchmarks of DBClass on synthetic alias tables: get_address, add_alias, import_new_aliases and
+purge_old_entries. The dates of the generated aliases follow an exponential distribution (most aliases are recent,
+few are old, mean age 30 days), so that purge_old_entries removes a realistic share of the table.
+
+The results are printed as table and appended as JSON lines to --json, one line per benchmark and table size, so
+that they can be tracked over time.
+
+usage (from the repository root):
+    python -m test.benchmarks.bench_db [--rows 10000 100000 1000000] [--json FILE] [--wal]
+
+"""
+__author__ = "Guido Boehm"
+__filename__ = "bench_db.py"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.0.1"
+__maintainer__ = "Guido Boehm"
+__email__ = "guido@family-boehm.de"
+__status__ = "Prototype"
+__copyright__ = "Copyright(c) 2022) - Guido Boehm"
+
+#  Copyright 2022, Guido Boehm
+#  All Rights Reserved.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#  OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#  WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+import argparse
+import json
+import logging
+import random
+import tempfile
+import time
+
+from datetime import date, datetime, timedelta
+from itertools import islice
+from pathlib import Path
+
+from src.classes import DBClass
+from src.DSGVO_Tracking_Mail import import_new_aliases
+
+TABLE = 'alias'
+RETENTION_PERIOD = 60
+# mean age in days of the generated aliases
+MEAN_AGE = 30
+
+
+def generate_aliases(count, seed=0, start=0):
+    """
+    generates rows (email, alias, date) for the alias table
+    Args:
+        count (int): number of rows
+        seed (int): (optional) seed of the random generator, the same seed generates the same table
+        start (int): (optional) number of the first alias
+
+    Yields:
+        row (tuple): email, alias and date (YYYY-MM-DD)
+
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    for n in range(start, start + count):
+        age = min(int(rng.expovariate(1 / MEAN_AGE)), 365)
+        yield ('user{0}@example.com'.format(rng.randrange(count // 10 + 1)), 'alias{0}@alias.example'.format(n),
+               (today - timedelta(days=age)).strftime('%Y-%m-%d'))
+
+
+def fill_table(db_con, rows, seed=0):
+    """inserts generated rows directly, much faster than add_alias for millions of rows"""
+    generated = generate_aliases(rows, seed)
+    with db_con.conn:
+        while chunk := list(islice(generated, 100000)):
+            db_con.conn.executemany(f'INSERT INTO {TABLE} VALUES(?, ?, ?)', chunk)
+
+
+def percentile(values, fraction):
+    """returns the value below which fraction of the sorted values fall"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def result(benchmark, rows, ops, seconds, latencies=None):
+    """builds the result record of a benchmark"""
+    record = {'benchmark': benchmark, 'rows': rows, 'ops': ops, 'seconds': round(seconds, 6),
+              'ops_per_second': round(ops / seconds, 1) if seconds else None}
+    if latencies:
+        latencies.sort()
+        record['p50_us'] = round(percentile(latencies, 0.5) * 1e6, 2)
+        record['p99_us'] = round(percentile(latencies, 0.99) * 1e6, 2)
+    return record
+
+
+def timed_calls(function, arguments):
+    """calls function for each argument and returns the total time and the latency of each call"""
+    latencies = []
+    start = time.perf_counter()
+    for argument in arguments:
+        call_start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - call_start)
+    return time.perf_counter() - start, latencies
+
+
+def bench_table(rows, args, directory):
+    """runs all benchmarks against a table of rows aliases and returns the results"""
+    database = str(Path(directory, 'bench_{0}.db'.format(rows)))
+    pragmas = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'} if args.wal else None
+    db_con = DBClass(database, TABLE, RETENTION_PERIOD, pragmas=pragmas)
+    fill_table(db_con, rows)
+    rng = random.Random(1)
+    results = []
+
+    # 90% known aliases, 10% unknown ones
+    aliases = ['alias{0}@alias.example'.format(rng.randrange(rows) if rng.random() < 0.9 else rows + n)
+               for n in range(args.lookups)]
+    seconds, latencies = timed_calls(db_con.get_address, aliases)
+    results.append(result('get_address', rows, len(aliases), seconds, latencies))
+
+    start = time.perf_counter()
+    db_con.get_addresses(aliases)
+    results.append(result('get_addresses', rows, len(aliases), time.perf_counter() - start))
+
+    new_rows = list(generate_aliases(args.inserts, seed=2, start=rows))
+    seconds, latencies = timed_calls(lambda row: db_con.add_alias(*row), new_rows)
+    results.append(result('add_alias', rows, len(new_rows), seconds, latencies))
+
+    import_file = Path(directory, 'import.csv')
+    import_file.write_text(''.join('{0},{1}\n'.format(email, alias) for email, alias, _ in
+                                   generate_aliases(args.import_rows, seed=3, start=rows + args.inserts)))
+    start = time.perf_counter()
+    import_new_aliases(import_file, db_con)
+    results.append(result('import_new_aliases', rows, args.import_rows, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    purged = db_con.purge_old_entries()
+    results.append(result('purge_old_entries', rows, purged, time.perf_counter() - start))
+    db_con.close()
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='micro benchmarks of DBClass on synthetic alias tables')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='table sizes to be benchmarked, up to 10000000')
+    parser.add_argument('--lookups', type=int, default=10000, help='number of get_address calls')
+    parser.add_argument('--inserts', type=int, default=1000, help='number of add_alias calls')
+    parser.add_argument('--import-rows', type=int, default=10000, help='number of rows of the import file')
+    parser.add_argument('--wal', action='store_true', help='journal_mode WAL and synchronous NORMAL')
+    parser.add_argument('--json', type=Path, help='append the results as JSON lines to this file')
+    args = parser.parse_args(args)
+    # import_new_aliases logs every skipped alias
+    logging.getLogger('src.DSGVO_Tracking_Mail').setLevel(logging.CRITICAL)
+
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    print('{0:<20} {1:>10} {2:>10} {3:>12} {4:>10} {5:>10}'.format('benchmark', 'rows', 'ops', 'ops/s', 'p50 µs',
+                                                                   'p99 µs'))
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            for record in bench_table(rows, args, directory):
+                print('{benchmark:<20} {rows:>10} {ops:>10} {ops_per_second:>12} {0:>10} {1:>10}'.format(
+                        record.get('p50_us', '-'), record.get('p99_us', '-'), **record))
+                if args.json:
+                    with args.json.open('a') as file:
+                        file.write(json.dumps(dict(record, timestamp=timestamp, wal=args.wal)) + '\n')
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,326 @@
+"""
+Project: TrackingMailProvider
+Filename: bench_end_to_end.py
+Description
+
+end-to-end benchmark: runs main() against in-process stand-ins for the IMAP and the SMTP server. The catch-all
+mailbox is generated from the .eml templates of the unit tests, message n is sent to alias<n>@bench.example of which
+every 10th is unknown. Messages are generated on the fly, so the mailbox doesn't distort the memory usage.
+
+Reported per mailbox size: messages/second, p50/p99 latency per message (first FETCH of the message until it has
+been received by the SMTP sink) and peak RSS. Each size runs in its own process so that peak RSS isn't inherited.
+
+usage (from the repository root):
+    python -m test.benchmarks.bench_end_to_end [--messages 1000 10000 100000] [--async] [--workers N] [--json FILE]
+
+"""
+__author__ = "Guido Boehm"
+__filename__ = "bench_end_to_end.py"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.0.1"
+__maintainer__ = "Guido Boehm"
+__email__ = "guido@family-boehm.de"
+__status__ = "Prototype"
+__copyright__ = "Copyright(c) 2022) - Guido Boehm"
+
+#  Copyright 2022, Guido Boehm
+#  All Rights Reserved.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#  OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#  WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+import argparse
+import json
+import re
+import resource
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import date
+from pathlib import Path
+
+import yaml
+
+DATA_DIR = Path(Path(__file__).resolve().parent.parent, 'unittests', 'data')
+# header fields requested by IMAP_Class.HEADER_FIELDS
+HEADER_FIELDS = (b'from', b'to', b'received-spf')
+
+
+class Mailbox:
+    """
+    synthetic catch-all mailbox of count messages, message n (1-based) is built from template n % len(templates)
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.seen = bytearray(count + 1)
+        self.templates = [Mailbox.split_template(path.read_bytes()) for path in sorted(DATA_DIR.glob('*.eml'))]
+        # perf_counter of the first FETCH per message
+        self.served = {}
+
+    @staticmethod
+    def split_template(raw):
+        """
+        splits a template at the value of its To header, returns the parts of the message and of the header fields
+        """
+        header, separator, body = raw.partition(b'\n\n')
+        lines = []
+        for line in header.split(b'\n'):
+            if line[:1] in (b' ', b'\t') and lines:
+                lines[-1] += b'\n' + line
+            else:
+                lines.append(line)
+        fields = b'\r\n'.join(line for line in lines if line.split(b':', 1)[0].lower() in HEADER_FIELDS) + b'\r\n\r\n'
+        to = re.compile(rb'^To: [^\r\n]*', re.MULTILINE)
+        head, tail = to.split(header + separator + body, 1)
+        fields_head, fields_tail = to.split(fields, 1)
+        return head + b'To: ', tail, fields_head + b'To: ', fields_tail
+
+    @staticmethod
+    def alias(n):
+        return b'alias%d@bench.example' % n
+
+    def message(self, n, header_fields=False):
+        """returns message n, or only its header fields"""
+        head, tail, fields_head, fields_tail = self.templates[n % len(self.templates)]
+        self.served.setdefault(n, time.perf_counter())
+        if header_fields:
+            return fields_head + Mailbox.alias(n) + fields_tail
+        return b'X-Bench-Id: %d\r\n' % n + head + Mailbox.alias(n) + tail
+
+    def ids(self, sequence_set):
+        """resolves an IMAP sequence set such as 1:3,5,7:*"""
+        for part in sequence_set.split(','):
+            first, _, last = part.partition(':')
+            first = self.count if first == '*' else int(first)
+            last = first if not last else self.count if last == '*' else int(last)
+            yield from range(min(first, last), min(max(first, last), self.count) + 1)
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    """
+    the subset of IMAP4rev1 and UIDPLUS that is used by IMAP_Class. UIDs are equal to the sequence numbers
+    """
+    # small replies would be delayed by Nagle's algorithm otherwise
+    disable_nagle_algorithm = True
+
+    def reply(self, *lines):
+        self.wfile.write(b''.join(line if isinstance(line, bytes) else line.encode() for line in lines))
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.reply('* OK [CAPABILITY IMAP4rev1 UIDPLUS] bench server ready\r\n')
+        while line := self.rfile.readline():
+            tag, command, *args = line.decode().rstrip('\r\n').split(' ', 2)
+            command = command.upper()
+            uid = command == 'UID'
+            if uid:
+                command, *args = args[0].split(' ', 1)
+                command = command.upper()
+            args = args[0] if args else ''
+            if command == 'CAPABILITY':
+                self.reply('* CAPABILITY IMAP4rev1 UIDPLUS\r\n')
+            elif command == 'SELECT':
+                self.reply(f'* {mailbox.count} EXISTS\r\n', '* 0 RECENT\r\n', '* OK [UIDVALIDITY 1]\r\n',
+                           f'* OK [UIDNEXT {mailbox.count + 1}]\r\n')
+            elif command == 'SEARCH':
+                if args.upper().startswith('UID '):
+                    ids = mailbox.ids(args.split()[1])
+                elif args.upper() == 'NOT SEEN':
+                    ids = (n for n in range(1, mailbox.count + 1) if not mailbox.seen[n])
+                else:
+                    # BEFORE: all messages have been received today
+                    ids = ()
+                self.reply('* SEARCH', *(f' {n}' for n in ids), '\r\n')
+            elif command == 'FETCH':
+                message_set, parts = args.split(' ', 1)
+                header_fields = 'HEADER.FIELDS' in parts.upper()
+                item = 'BODY[HEADER.FIELDS (FROM TO RECEIVED-SPF)]' if header_fields else 'RFC822'
+                response = []
+                for n in mailbox.ids(message_set):
+                    data = mailbox.message(n, header_fields)
+                    if not header_fields:
+                        mailbox.seen[n] = 1
+                    uid_item = f'UID {n} ' if uid else ''
+                    response.append(f'* {n} FETCH ({uid_item}{item} {{{len(data)}}}\r\n'.encode() + data + b')\r\n')
+                self.reply(*response)
+            elif command == 'STORE':
+                message_set, _, flags = args.split(' ', 2)
+                if '\\SEEN' in flags.upper():
+                    for n in mailbox.ids(message_set):
+                        mailbox.seen[n] = 1
+            elif command == 'LOGOUT':
+                self.reply('* BYE bench server logging out\r\n', f'{tag} OK LOGOUT completed\r\n')
+                return
+            self.reply(f'{tag} OK {command} completed\r\n')
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    SMTP sink: accepts every message and records when it has been received
+    """
+    # small replies would be delayed by Nagle's algorithm otherwise
+    disable_nagle_algorithm = True
+    BENCH_ID = re.compile(rb'^X-Bench-Id: (\d+)', re.MULTILINE)
+
+    def handle(self):
+        self.wfile.write(b'220 bench server ready\r\n')
+        while line := self.rfile.readline():
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-bench\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 end data with <CR><LF>.<CR><LF>\r\n')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(line)
+                bench_id = SMTPHandler.BENCH_ID.search(b''.join(data[:1]))
+                with self.server.lock:
+                    self.server.received[int(bench_id.group(1)) if bench_id else -1] = time.perf_counter()
+                self.wfile.write(b'250 OK\r\n')
+            elif command == b'AUTH':
+                self.wfile.write(b'235 authentication successful\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+def start_server(handler, **attributes):
+    """starts a threaded server on a free port of localhost, the port validators of MailHost allow up to 9999"""
+    for port in range(9000, 10000):
+        try:
+            server = socketserver.ThreadingTCPServer(('127.0.0.1', port), handler)
+            break
+        except OSError:
+            continue
+    else:
+        raise OSError('no free port between 9000 and 9999')
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(directory, imap_port, smtp_port, args):
+    """writes the configuration for main() and returns its path"""
+    config = {
+        'LOGGING': {'logfilename': 'bench.log', 'path_to_logfile': directory + '/',
+                    'level_file': 'ERROR', 'level_screen': 'ERROR', 'filesize': 10000000, 'filecount': 1},
+        'IMAP': {'host': '127.0.0.1', 'port': imap_port, 'username': 'bench', 'password': 'bench', 'ssl': False,
+                 'tls': False, 'retention_period': 60, 'chunk_size': args.chunk_size,
+                 'header_prefilter': not args.no_prefilter},
+        'SMTP': {'host': '127.0.0.1', 'port': smtp_port, 'username': 'bench', 'password': 'bench', 'ssl': False,
+                 'tls': False, 'pool_size': args.pool_size},
+        'FORWARD': {'from': 'forwarder@bench.example', 'bcc': None, 'SPFcheck': True},
+        'SQLITE': {'dbname': 'alias.db', 'directory': directory, 'table': 'alias', 'retention_period': 60},
+        'METRICS': {'json_file': str(Path(directory, 'metrics.json'))},
+        'IMPORT': {'filename': 'import.csv', 'directory': directory},
+        'WHITELIST': {'allowed_domains': ['example.com']},
+    }
+    config_file = Path(directory, 'config.yaml')
+    config_file.write_text(yaml.safe_dump(config))
+    return config_file
+
+
+def percentile(values, fraction):
+    """returns the value below which fraction of the sorted values fall"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_single(args):
+    """runs main() once against a mailbox of args.single messages and returns the results"""
+    from src import DSGVO_Tracking_Mail
+    from src.classes import DBClass
+
+    mailbox = Mailbox(args.single)
+    imap_server = start_server(IMAPHandler, mailbox=mailbox)
+    smtp_server = start_server(SMTPHandler, received={}, lock=threading.Lock())
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = write_config(directory, imap_server.server_address[1], smtp_server.server_address[1], args)
+        # the aliases are imported beforehand, every 10th alias is unknown
+        db_con = DBClass(str(Path(directory, 'alias.db')), 'alias', 60)
+        db_con.add_aliases_bulk((['forward{0}@bench.example'.format(n), Mailbox.alias(n).decode()]
+                                 for n in range(1, args.single + 1) if n % 10), date.today().strftime('%Y-%m-%d'))
+        db_con.close()
+
+        main_args = ['--config', str(config_file), '--workers', str(args.workers)]
+        if args.pipeline:
+            main_args.append('--async')
+        start = time.perf_counter()
+        try:
+            DSGVO_Tracking_Mail.main(main_args)
+        except SystemExit as err:
+            if err.code:
+                raise
+        seconds = time.perf_counter() - start
+        stages = json.loads(Path(directory, 'metrics.json').read_text().splitlines()[-1])
+    imap_server.shutdown()
+    smtp_server.shutdown()
+
+    latencies = sorted(received - mailbox.served[n] for n, received in smtp_server.received.items())
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'messages': args.single,
+            'sent': len(smtp_server.received),
+            'seconds': round(seconds, 3),
+            'messages_per_second': round(args.single / seconds, 1),
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            # kilobytes on Linux, bytes on macOS
+            'peak_rss_mb': round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+            'stages': stages['timers']}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='end-to-end benchmark against local IMAP and SMTP stand-ins')
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='mailbox sizes to be benchmarked')
+    parser.add_argument('--async', dest='pipeline', action='store_true', help='run main() with --async')
+    parser.add_argument('--workers', type=int, default=1, help='run main() with --workers N')
+    parser.add_argument('--pool-size', type=int, default=1, help='SMTP.pool_size')
+    parser.add_argument('--chunk-size', type=int, default=500, help='IMAP.chunk_size')
+    parser.add_argument('--no-prefilter', action='store_true', help='IMAP.header_prefilter: False')
+    parser.add_argument('--json', type=Path, help='write the results to this file, e.g. to compare two versions')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+
+    if args.single:
+        print(json.dumps(run_single(args)))
+        return
+
+    results = []
+    print('{0:>9} {1:>9} {2:>10} {3:>10} {4:>10} {5:>10}'.format('messages', 'sent', 'msgs/s', 'p50 ms', 'p99 ms',
+                                                                  'RSS MB'))
+    for count in args.messages:
+        # fresh process per size, peak RSS would carry over otherwise
+        child_args = [a for a in (args.pipeline and '--async', '--no-prefilter' if args.no_prefilter else None) if a]
+        output = subprocess.run([sys.executable, '-m', 'test.benchmarks.bench_end_to_end', '--single', str(count),
+                                 '--workers', str(args.workers), '--pool-size', str(args.pool_size),
+                                 '--chunk-size', str(args.chunk_size)] + child_args,
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        results.append(result)
+        print('{messages:>9} {sent:>9} {messages_per_second:>10} {latency_p50_ms:>10} {latency_p99_ms:>10} '
+              '{peak_rss_mb:>10}'.format(**result))
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+
+    main()
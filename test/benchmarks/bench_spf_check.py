@@ -0,0 +1,76 @@
+"""
+Project: TrackingMailProvider
+Filename: bench_spf_check.py
+Description
+
+micro benchmark of the SPF check: serializing and re-parsing the whole message (up to version 2.0.2) compared to
+reading the Received-SPF headers from the parsed message
+
+usage (from the repository root):
+    python -m test.benchmarks.bench_spf_check [--number N]
+
+"""
+__author__ = "Guido Boehm"
+__filename__ = "bench_spf_check.py"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.0.1"
+__maintainer__ = "Guido Boehm"
+__email__ = "guido@family-boehm.de"
+__status__ = "Prototype"
+__copyright__ = "Copyright(c) 2022) - Guido Boehm"
+
+#  Copyright 2022, Guido Boehm
+#  All Rights Reserved.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#  OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#  WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+import argparse
+import email
+import timeit
+
+from email.parser import HeaderParser
+from pathlib import Path
+from src.classes import Message
+
+DATA_DIR = Path(Path(__file__).resolve().parent.parent, 'unittests', 'data')
+
+
+def spf_check_reparse(message):
+    """SPF check as done up to version 2.0.2: whole message is serialized and parsed again"""
+    headers = HeaderParser().parsestr(message.as_string())
+    received_spf = headers.get('Received-SPF')
+    return any(code in received_spf for code in Message.SPF_CODES)
+
+
+def spf_check_headers(message):
+    """SPF check on the headers of the parsed message"""
+    return Message.spf_passed(message.get_all('Received-SPF'))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='micro benchmark of the SPF check')
+    parser.add_argument('--number', type=int, default=2000, help='number of checks per variant')
+    parser.add_argument('--body-size', type=int, default=50000,
+                        help='size of the body in bytes, tracking mails often contain large HTML parts')
+    args = parser.parse_args(args)
+
+    raw = Path(DATA_DIR, 'test_subject.eml').read_bytes()
+    raw += b'x' * args.body_size + b'\r\n'
+    message = email.message_from_bytes(raw)
+
+    for name, check in (('re-parse (before)', spf_check_reparse), ('headers (after)', spf_check_headers)):
+        seconds = min(timeit.repeat(lambda: check(message), number=args.number, repeat=3))
+        print('{0:<20} {1:10.2f} µs/message'.format(name, seconds / args.number * 1e6))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,591 @@
+"""
+Project: TrackingMailProvider
+Filename: test_DSGVO_Tracking_Mail.py
+Description
+
+"""
+__author__ = "Guido Boehm"
+__filename__ = "test_DSGVO_Tracking_Mail.py"
+__credits__ = [""]
+__license__ = ""
+__version__ = "0.0.1"
+__maintainer__ = "Guido Boehm"
+__email__ = "guido@family-boehm.de"
+__status__ = "Prototype"
+__copyright__ = "Copyright(c) 2022) - Guido Boehm"
+
+#  Copyright 2022, Guido Boehm
+#  All Rights Reserved.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+#  EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+#  OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+#  NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+#  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+#  WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+import asyncio
+import imaplib
+import os
+import signal
+import smtplib
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from pathlib import Path
+from unittest import TestCase
+
+import src.DSGVO_Tracking_Mail as tracking_mail
+from src.classes import DBClass, IMAP_Class, LazyMessage, Message, SMTP_Pool, init_worker
+from src.DSGVO_Tracking_Mail import (check_fetched, collect_messages, file_fingerprint, import_new_aliases,
+                                     iter_messages, read_chunks, run_daemon, run_pipeline)
+
+DATA_DIR = Path(Path.cwd(), 'unittests', 'data')
+
+# Excel BOM, an invalid row, an empty line and a quoted note with a line break
+IMPORT_DATA = ('﻿foo1@foobar.com,alias1@alias.com\r\n'
+               'no_address,alias2@alias.com\r\n'
+               '\r\n'
+               'foo3@foobar.com,alias3@alias.com,"note\r\nwith line break"\r\n'
+               'foo4@foobar.com,alias4@alias.com\r\n').encode('utf-8')
+
+
+class TestImportNewAliases(TestCase):
+
+    def setUp(self) -> None:
+        self.conn = DBClass(Path(DATA_DIR, 'test.db'), 'alias')
+        self.directory = tempfile.TemporaryDirectory()
+        self.import_file = Path(self.directory.name, 'import.csv')
+        self.import_file.write_bytes(IMPORT_DATA)
+
+    def tearDown(self) -> None:
+        self.conn.close()
+        Path(DATA_DIR, 'test.db').unlink()
+        self.directory.cleanup()
+
+    def aliases(self):
+        return [row[1] for row in self.conn.conn.execute('SELECT * FROM alias ORDER BY alias')]
+
+    def test_read_chunks(self):
+        with self.import_file.open('rb') as file:
+            chunks = list(read_chunks(file, 2))
+        with self.subTest(test_number=0):
+            # BOM removed
+            self.assertEqual(chunks[0][0][0], ['foo1@foobar.com', 'alias1@alias.com'])
+        with self.subTest(test_number=1):
+            # the quoted line break doesn't split the row
+            self.assertEqual([len(rows) for rows, _ in chunks], [2, 2, 1])
+            self.assertEqual(chunks[1][0][1], ['foo3@foobar.com', 'alias3@alias.com', 'note\r\nwith line break'])
+        with self.subTest(test_number=2):
+            # offsets point behind the last row of each chunk
+            self.assertEqual(chunks[-1][1], len(IMPORT_DATA))
+            self.assertTrue(IMPORT_DATA[:chunks[1][1]].endswith(b'break"\r\n'))
+
+    def test_import(self):
+        with self.assertLogs('src.DSGVO_Tracking_Mail', 'ERROR') as logs:
+            import_new_aliases(self.import_file, self.conn, chunk_size=2)
+        with self.subTest(test_number=0):
+            self.assertEqual(self.aliases(), ['alias1@alias.com', 'alias3@alias.com', 'alias4@alias.com'])
+        with self.subTest(test_number=1):
+            # invalid row rejected
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('no_address,alias2@alias.com', logs.output[0])
+        with self.subTest(test_number=2):
+            # file and checkpoint removed
+            self.assertFalse(self.import_file.exists())
+            self.assertIsNone(self.conn.conn.execute('SELECT * FROM alias_import').fetchone())
+
+    def test_resume(self):
+        add_aliases_bulk = self.conn.add_aliases_bulk
+        calls = []
+
+        def crash(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return add_aliases_bulk(*args, **kwargs)
+
+        self.conn.add_aliases_bulk = crash
+        with self.assertRaises(KeyboardInterrupt), self.assertLogs('src.DSGVO_Tracking_Mail', 'ERROR'):
+            import_new_aliases(self.import_file, self.conn, chunk_size=2)
+        offset = self.conn.get_import_offset('import.csv', file_fingerprint(self.import_file))
+        with self.subTest(test_number=0):
+            # the first chunk and its checkpoint are stored, the file is kept
+            self.assertEqual(self.aliases(), ['alias1@alias.com'])
+            self.assertEqual(offset, IMPORT_DATA.index(b'\r\n\r\n') + 2)
+            self.assertTrue(self.import_file.exists())
+
+        self.conn.add_aliases_bulk = add_aliases_bulk
+        with self.assertLogs('src.DSGVO_Tracking_Mail', 'INFO') as logs:
+            import_new_aliases(self.import_file, self.conn, chunk_size=2)
+        with self.subTest(test_number=1):
+            self.assertIn('ab Byte {0} fortgesetzt'.format(offset), logs.output[0])
+            # no duplicates reported, the first chunk isn't read again
+            self.assertFalse([line for line in logs.output if 'existiert bereits' in line])
+        with self.subTest(test_number=2):
+            self.assertEqual(self.aliases(), ['alias1@alias.com', 'alias3@alias.com', 'alias4@alias.com'])
+            self.assertFalse(self.import_file.exists())
+            self.assertIsNone(self.conn.conn.execute('SELECT * FROM alias_import').fetchone())
+
+    def test_changed_file(self):
+        # checkpoint of a previous file with the same name
+        self.conn.add_aliases_bulk([], '2022-01-01', checkpoint=('import.csv', 'other', len(IMPORT_DATA) - 10))
+        import_new_aliases(self.import_file, self.conn, chunk_size=2)
+        self.assertEqual(self.aliases(), ['alias1@alias.com', 'alias3@alias.com', 'alias4@alias.com'])
+
+
+class FakeIMAPSession:
+    """stands in for IMAP_Class, records the fetched and the explicitly flagged messages"""
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetched = 0
+        self.fetches = []
+        self.seen = []
+        self.closed = False
+
+    def fetch_messages(self, msg_ids, message_parts):
+        self.fetches.append((list(msg_ids), message_parts))
+        for msg_id in msg_ids:
+            self.fetched += 1
+            yield msg_id, self.messages[msg_id]
+
+    def mark_seen(self, msg_ids):
+        self.seen += msg_ids
+
+    def quit(self):
+        self.closed = True
+
+
+class FakeSMTPClass:
+    """stands in for SMTP_Class, messages to 'fail@example.com' are rejected, release blocks sending"""
+    release = threading.Event()
+    instances = []
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        FakeSMTPClass.instances.append(self)
+
+    def login(self):
+        pass
+
+    def send_message(self, from_address, to_address, message):
+        FakeSMTPClass.release.wait()
+        if 'fail@example.com' in to_address:
+            raise smtplib.SMTPRecipientsRefused({'fail@example.com': (550, b'unknown user')})
+        self.sent.append(to_address[0])
+
+    @property
+    def sent_count(self):
+        return len(self.sent)
+
+    def reset(self):
+        pass
+
+    def keep_alive(self):
+        pass
+
+    def quit(self):
+        self.closed = True
+
+
+class TestRunPipeline(TestCase):
+
+    def setUp(self) -> None:
+        FakeSMTPClass.instances = []
+        FakeSMTPClass.release.set()
+        Message.check_spf = False
+        Message.whitelist = ['example.com']
+        tracking_mail.metrics.reset()
+        self.connect_smtp = tracking_mail.connect_smtp
+        tracking_mail.connect_smtp = lambda config: SMTP_Pool(FakeSMTPClass, size=2)
+        self.config = {'FORWARD': {'from': 'versand@example.de', 'bcc': None}, 'PIPELINE': {'queue_size': 2}}
+        conn = DBClass(Path(DATA_DIR, 'test.db'), 'alias')
+        with Path(DATA_DIR, 'test_subject.eml').open('rb') as file:
+            file_content = file.read()
+        self.messages = {}
+        rows = []
+        for i in range(20):
+            msg_id = str(i).encode()
+            self.messages[msg_id] = file_content.replace(b'To: testemail@example.com',
+                                                         'To: alias{0}@alias.com'.format(i).encode())
+            # alias 3 is unknown, alias 5 is rejected by the smtp server
+            if i != 3:
+                rows.append(('fail@example.com' if i == 5 else 'foo{0}@foobar.com'.format(i),
+                             'alias{0}@alias.com'.format(i)))
+        conn.add_aliases_bulk(rows, date.today().strftime('%Y-%m-%d'))
+        conn.close()
+        self.imap = FakeIMAPSession(self.messages)
+
+    def tearDown(self) -> None:
+        FakeSMTPClass.release.set()
+        tracking_mail.connect_smtp = self.connect_smtp
+        Message.whitelist = []
+        Path(DATA_DIR, 'test.db').unlink()
+
+    def start(self, lookup=None):
+        """runs the pipeline in a thread, so that a hanging pipeline fails the test instead of blocking it"""
+        self.errors = []
+
+        def run():
+            # the DB connection can only be used by the thread of the event loop
+            conn = DBClass(Path(DATA_DIR, 'test.db'), 'alias')
+            if lookup is not None:
+                conn.get_address = lookup(conn.get_address)
+            try:
+                asyncio.run(run_pipeline(self.config, self.imap, conn, list(self.messages)))
+            except (Exception, SystemExit) as err:
+                self.errors.append(err)
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def test_forward(self):
+        thread = self.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        summary = tracking_mail.metrics.summary()['counters']
+        with self.subTest(test_number=0):
+            # every sender has received its end of stream marker
+            self.assertEqual(self.errors, [])
+            self.assertEqual((summary['fetched'], summary['unknown_alias'], summary['sent'], summary['failed']),
+                             (20, 1, 18, 1))
+        with self.subTest(test_number=1):
+            sent = sorted(address for smtp in FakeSMTPClass.instances for address in smtp.sent)
+            self.assertEqual(sent, sorted('foo{0}@foobar.com'.format(i) for i in range(20) if i not in (3, 5)))
+        with self.subTest(test_number=2):
+            self.assertTrue(all(smtp.closed for smtp in FakeSMTPClass.instances))
+
+    def test_backpressure(self):
+        FakeSMTPClass.release.clear()
+        thread = self.start()
+        thread.join(0.5)
+        with self.subTest(test_number=0):
+            # 2 messages being sent, 2 + 2 in the queues, 1 waiting in check and fetch each, 1 read ahead
+            self.assertLessEqual(self.imap.fetched, 9)
+        FakeSMTPClass.release.set()
+        thread.join(5)
+        with self.subTest(test_number=1):
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(self.imap.fetched, 20)
+
+    def test_smtp_unavailable(self):
+        tracking_mail.connect_smtp = lambda config: None
+        thread = self.start()
+        thread.join(5)
+        with self.subTest(test_number=0):
+            self.assertFalse(thread.is_alive())
+            self.assertEqual([type(err) for err in self.errors], [SystemExit])
+            self.assertEqual(self.imap.fetched, 0)
+        with self.subTest(test_number=1):
+            # logged out before the script terminates
+            self.assertTrue(self.imap.closed)
+
+    def test_stage_failure(self):
+        def failing_lookup(get_address):
+            calls = []
+
+            def lookup(alias):
+                calls.append(alias)
+                if len(calls) == 1:
+                    raise sqlite3.OperationalError('database is locked')
+                return get_address(alias)
+            return lookup
+
+        thread = self.start(failing_lookup)
+        thread.join(5)
+        with self.subTest(test_number=0):
+            # the other stages are stopped instead of waiting for each other
+            self.assertFalse(thread.is_alive())
+            self.assertEqual([type(err) for err in self.errors], [sqlite3.OperationalError])
+        with self.subTest(test_number=1):
+            self.assertLess(self.imap.fetched, 20)
+            self.assertTrue(all(smtp.closed for smtp in FakeSMTPClass.instances))
+
+
+class TestCheckFetched(TestCase):
+
+    def setUp(self) -> None:
+        self.fetched = []
+        for i, file_name in enumerate(['test_subject.eml', 'test_subject_fail.eml', 'test_subject.eml']):
+            with Path(DATA_DIR, file_name).open('rb') as file:
+                raw_message = file.read()
+            if i == 2:
+                raw_message = raw_message.replace(b'paul_positive@example.com', b'paul_positive@foobar.com')
+            self.fetched.append((str(i + 1).encode(), raw_message))
+        Message.check_spf = False
+        # a new list creates a new matcher with empty statistics
+        Message.whitelist = ['example.com']
+
+    def tearDown(self) -> None:
+        Message.whitelist = []
+
+    def test_whitelist_stats(self):
+        results = list(check_fetched(self.fetched))
+        local_stats = Message.whitelist_matcher().stats()
+        Message.whitelist = ['example.com']
+        with ProcessPoolExecutor(2, initializer=init_worker, initargs=(False, ['example.com'])) as executor:
+            worker_results = list(check_fetched(self.fetched, executor))
+        with self.subTest(test_number=0):
+            self.assertEqual([checked.domain_whitelisted for _, _, checked in worker_results],
+                             [checked.domain_whitelisted for _, _, checked in results])
+        with self.subTest(test_number=1):
+            # matched in the workers, counted in this process
+            self.assertEqual(Message.whitelist_matcher().stats(), local_stats)
+            self.assertEqual(local_stats['rejects'], {'foobar.com': 1})
+
+
+class TestCollectMessages(TestCase):
+
+    def setUp(self) -> None:
+        Message.check_spf = False
+        # a new list creates a new matcher with empty statistics
+        Message.whitelist = ['example.com']
+        tracking_mail.metrics.reset()
+        self.config = {'IMAP': {}, 'FORWARD': {'from': 'versand@example.de', 'bcc': None}}
+        self.conn = DBClass(Path(DATA_DIR, 'test.db'), 'alias')
+        with Path(DATA_DIR, 'test_subject.eml').open('rb') as file:
+            file_content = file.read()
+        self.messages = {}
+        for i in range(4):
+            raw_message = file_content.replace(b'To: testemail@example.com',
+                                               'To: alias{0}@alias.com'.format(i).encode())
+            if i == 3:
+                # not whitelisted
+                raw_message = raw_message.replace(b'paul_positive@example.com', b'paul_positive@foobar.com')
+            self.messages[str(i).encode()] = raw_message
+        self.conn.add_aliases_bulk([('foo{0}@foobar.com'.format(i), 'alias{0}@alias.com'.format(i))
+                                    for i in range(4)], date.today().strftime('%Y-%m-%d'))
+        self.imap = FakeIMAPSession(self.messages)
+
+    def tearDown(self) -> None:
+        Message.whitelist = []
+        self.conn.close()
+        Path(DATA_DIR, 'test.db').unlink()
+
+    def check_result(self, messages):
+        with self.subTest(test_number=0):
+            self.assertEqual([message.TO_address for message in messages],
+                             ['foo0@foobar.com', 'foo1@foobar.com', 'foo2@foobar.com'])
+            self.assertTrue(all(isinstance(message, LazyMessage) for message in messages))
+        with self.subTest(test_number=1):
+            # every message is checked and counted once
+            self.assertEqual(Message.whitelist_matcher().stats(),
+                             {'matches': {'example.com': 3}, 'rejects': {'foobar.com': 1}})
+
+    def test_collect(self):
+        self.check_result(collect_messages(self.config, self.imap, self.conn, list(self.messages)))
+
+    def test_workers(self):
+        parsed = []
+        parse_message = tracking_mail.parse_message
+        tracking_mail.parse_message = lambda raw_message: parsed.append(raw_message) or parse_message(raw_message)
+        try:
+            with ProcessPoolExecutor(2, initializer=init_worker, initargs=(False, ['example.com'])) as executor:
+                messages = collect_messages(self.config, self.imap, self.conn, list(self.messages), executor)
+        finally:
+            tracking_mail.parse_message = parse_message
+        self.check_result(messages)
+        with self.subTest(test_number=2):
+            # the messages to be forwarded aren't parsed and checked again by the main process
+            self.assertEqual(parsed, [])
+
+    def test_header_prefilter(self):
+        self.config['IMAP']['header_prefilter'] = True
+        messages = collect_messages(self.config, self.imap, self.conn, list(self.messages))
+        self.check_result(messages)
+        with self.subTest(test_number=2):
+            # headers of all messages, full messages of those to be forwarded only
+            self.assertEqual(self.imap.fetches, [(list(self.messages), IMAP_Class.HEADER_FIELDS),
+                                                 ([b'0', b'1', b'2'], '(RFC822)')])
+            self.assertEqual(self.imap.seen, [b'3'])
+        with self.subTest(test_number=3):
+            # the full message is forwarded
+            self.assertEqual(messages[0].raw, self.messages[b'0'])
+
+    def test_iter_messages_chunks(self):
+        chunk_size = IMAP_Class.chunk_size
+        IMAP_Class.chunk_size = 3
+        try:
+            messages = list(iter_messages(self.config, self.imap, self.conn, list(self.messages)))
+        finally:
+            IMAP_Class.chunk_size = chunk_size
+        with self.subTest(test_number=0):
+            self.assertEqual([message.TO_address for message in messages],
+                             ['foo0@foobar.com', 'foo1@foobar.com', 'foo2@foobar.com'])
+        with self.subTest(test_number=1):
+            # 4 messages in chunks of 3
+            self.assertEqual([msg_ids for msg_ids, _ in self.imap.fetches], [[b'0', b'1', b'2'], [b'3']])
+
+    def test_iter_messages_nothing_to_fetch(self):
+        self.assertEqual(list(iter_messages(self.config, self.imap, self.conn, [])), [])
+        self.assertEqual(self.imap.fetches, [])
+
+    def test_iter_messages_early_termination(self):
+        chunk_size = IMAP_Class.chunk_size
+        IMAP_Class.chunk_size = 2
+        try:
+            messages = iter_messages(self.config, self.imap, self.conn, list(self.messages))
+            next(messages)
+            with self.subTest(test_number=0):
+                # only the first chunk has been fetched
+                self.assertEqual([msg_ids for msg_ids, _ in self.imap.fetches], [[b'0', b'1']])
+            messages.close()
+            with self.subTest(test_number=1):
+                # nothing is fetched after the consumer has stopped
+                self.assertEqual(len(self.imap.fetches), 1)
+            messages = iter_messages(self.config, self.imap, self.conn, list(self.messages))
+            self.imap.fetches = []
+            self.assertEqual(len(list(messages)), 3)
+            with self.subTest(test_number=2):
+                # each chunk is fetched exactly once
+                self.assertEqual([msg_ids for msg_ids, _ in self.imap.fetches], [[b'0', b'1'], [b'2', b'3']])
+        finally:
+            IMAP_Class.chunk_size = chunk_size
+
+
+class FakeDaemonIMAPSession:
+    """stands in for IMAP_Class in daemon mode, each call of idle runs the next of the given actions"""
+    def __init__(self, actions, folder_error=None):
+        self.actions = list(actions)
+        self.folder_error = folder_error
+        self.idles = 0
+        self.closed = False
+        self.session = self
+
+    def folder(self, folder):
+        if self.folder_error is not None:
+            raise self.folder_error
+
+    def idle(self, timeout, watcher=None):
+        self.idles += 1
+        action = self.actions.pop(0)
+        if isinstance(action, BaseException):
+            raise action
+        return action()
+
+    def quit(self):
+        self.closed = True
+
+    def shutdown(self):
+        self.closed = True
+
+
+class FakeDB:
+    """stands in for DBClass, only closing is of interest"""
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestRunDaemon(TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {'IMPORT': {'directory': self.directory.name},
+                       'DAEMON': {'reconnect_delay': 0, 'housekeeping_interval': 3600}}
+        self.db_con = FakeDB()
+        self.sessions = []
+        self.calls = []
+        self.originals = {}
+        self.patch('connect_imap', lambda config: self.sessions.pop(0))
+        self.patch('import_aliases', lambda config, db_con: self.calls.append('import'))
+        self.patch('get_new_ids', lambda config, imap_session, db_con: self.calls.append('search') or [])
+        self.patch('save_sync_state', lambda imap_session, db_con: None)
+        self.patch('purge_old_entries', lambda imap_session, db_con: self.calls.append('housekeeping'))
+        self.patch('write_metrics', lambda config: None)
+
+    def tearDown(self) -> None:
+        for name, value in self.originals.items():
+            setattr(tracking_mail, name, value)
+        self.directory.cleanup()
+
+    def patch(self, name, value):
+        self.originals.setdefault(name, getattr(tracking_mail, name))
+        setattr(tracking_mail, name, value)
+
+    def test_reconnect(self):
+        self.sessions = [FakeDaemonIMAPSession([imaplib.IMAP4.abort('connection lost')]),
+                         FakeDaemonIMAPSession([], folder_error=imaplib.IMAP4.abort('dropped after login')),
+                         FakeDaemonIMAPSession([imaplib.IMAP4.error('IDLE rejected')]),
+                         FakeDaemonIMAPSession([lambda: True, SystemExit(0)])]
+        sessions = list(self.sessions)
+        with self.assertRaises(SystemExit), self.assertLogs('src.DSGVO_Tracking_Mail', 'ERROR') as logs:
+            run_daemon(self.config, self.db_con)
+        with self.subTest(test_number=0):
+            # every failed session is closed and replaced by a new one
+            self.assertEqual(len(logs.output), 3)
+            self.assertTrue(all(session.closed for session in sessions))
+        with self.subTest(test_number=1):
+            self.assertEqual(sessions[-1].idles, 2)
+            self.assertTrue(self.db_con.closed)
+
+    def test_housekeeping(self):
+        self.sessions = [FakeDaemonIMAPSession([lambda: True, lambda: True, SystemExit(0)])]
+        with self.assertRaises(SystemExit):
+            run_daemon(self.config, self.db_con)
+        # right at the start, no matter how long the host has been running, and not again within the interval
+        self.assertEqual(self.calls, ['import', 'search', 'housekeeping', 'import', 'search', 'import', 'search'])
+
+    def test_import_error(self):
+        def import_new_aliases(import_file, db_con, chunk_size):
+            raise PermissionError('cannot delete import.csv')
+
+        # an import file that can't be deleted doesn't tear down the imap session
+        self.patch('import_new_aliases', import_new_aliases)
+        self.patch('import_aliases', self.originals['import_aliases'])
+        Path(self.directory.name, 'import.csv').write_text('foo@foobar.com,alias@alias.com\n')
+        session = FakeDaemonIMAPSession([lambda: True, SystemExit(0)])
+        self.sessions = [session]
+        with self.assertRaises(SystemExit), self.assertLogs('src.DSGVO_Tracking_Mail', 'ERROR') as logs:
+            run_daemon(self.config, self.db_con)
+        with self.subTest(test_number=0):
+            self.assertEqual(session.idles, 2)
+            self.assertEqual(self.calls.count('search'), 2)
+        with self.subTest(test_number=1):
+            # retried in the next cycle
+            self.assertEqual(len(logs.output), 2)
+            self.assertIn('cannot delete import.csv', logs.output[0])
+
+    def test_sigterm(self):
+        def wait_for_signal():
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(5)
+
+        session = FakeDaemonIMAPSession([wait_for_signal])
+        self.sessions = [session]
+        # handler as installed by main()
+        handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            start = time.monotonic()
+            with self.assertRaises(SystemExit):
+                run_daemon(self.config, self.db_con)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        with self.subTest(test_number=0):
+            self.assertLess(time.monotonic() - start, 5)
+        with self.subTest(test_number=1):
+            # imap session and DB are closed on the way out
+            self.assertTrue(session.closed)
+            self.assertTrue(self.db_con.closed)
+
+
+def main(args=None):
+    pass
+
+
+if __name__ == "__main__":
+
+    main()
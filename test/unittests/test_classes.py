@@ -27,9 +27,16 @@ __copyright__ = "Copyright(c) 2022) - Guido Boehm"
 #  OTHER DEALINGS IN THE SOFTWARE.
 #
 import email
+import json
+import smtplib
+import socket
 import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
+from concurrent.futures import ProcessPoolExecutor
 from csv import reader
 from pathlib import Path
 from src.classes import *
@@ -72,6 +79,20 @@ class TestDBClass(TestCase):
         self.conn.close()
         Path(DATA_DIR, 'test.db').unlink()
 
+    def test_pragmas(self):
+        self.conn.close()
+        self.conn = DBClass(Path(DATA_DIR, 'test.db'), self.table,
+                            pragmas={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 1000})
+        with self.subTest(test_number=0):
+            self.assertEqual(self.conn.conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(self.conn.conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(self.conn.conn.execute('PRAGMA busy_timeout').fetchone()[0], 1000)
+        bad_values = [{'foreign_keys': 'ON'}, {'journal_mode': 'WAL; DROP TABLE alias'}]
+        for i, value in enumerate(bad_values):
+            with self.subTest(test_number=i + 1):
+                with self.assertRaises(ValueError):
+                    DBClass(Path(DATA_DIR, 'test.db'), self.table, pragmas=value)
+
     def test_validate(self):
         """tests date format validation"""
         bad_values = ['a', 1, '2022.02.02', '01.01.2022', '2022/02/02', '2022-13-44']
@@ -102,6 +123,28 @@ class TestDBClass(TestCase):
                         self.conn.add_alias(row[0], row[1], date.today().strftime('%Y-%m-%d'))
                     i += 1
 
+    def test_add_aliases_bulk(self):
+        today_ = date.today().strftime('%Y-%m-%d')
+        self.conn.add_alias('foo@foobar.com', 'alias4@ALIAS.com', today_)
+        import_file = Path(DATA_DIR, 'valid_data.csv')
+        with import_file.open('r') as file:
+            rows = list(reader(file))
+        # duplicate within the rows, alias already in DB and an empty row
+        rows += [['foo@foobar.com', 'ALIAS1@alias.com'], []]
+        result = self.conn.add_aliases_bulk(iter(rows), today_)
+        with self.subTest(test_number=0):
+            self.assertEqual(result.inserted, 3)
+            self.assertEqual(result.skipped, 2)
+        with self.subTest(test_number=1):
+            self.assertEqual(result.skipped_aliases, ['alias4@Alias.com', 'ALIAS1@alias.com'])
+        with self.subTest(test_number=2):
+            # the first row of a duplicate is kept
+            self.assertEqual(self.conn.get_address('alias1@alias.com'), 'foo1@foobar.com')
+            self.assertEqual(self.conn.get_address('alias4@alias.com'), 'foo@foobar.com')
+        with self.subTest(test_number=3):
+            with self.assertRaises(ValueError):
+                self.conn.add_aliases_bulk(iter(rows), '2022/02/02')
+
     def test_get_address(self):
         import_file = Path(DATA_DIR, 'valid_data.csv')
         with import_file.open('r') as file:
@@ -113,6 +156,78 @@ class TestDBClass(TestCase):
         # query not in DB
         self.assertIsNone(self.conn.get_address('not_in_db'))
 
+    def test_get_addresses(self):
+        import_file = Path(DATA_DIR, 'valid_data.csv')
+        with import_file.open('r') as file:
+            self.conn.add_aliases_bulk(reader(file), date.today().strftime('%Y-%m-%d'))
+        aliases = ['AlIaS3@aLiAs.CoM', 'alias1@alias.com', 'not_in_db', None]
+        with self.subTest(test_number=0):
+            self.assertEqual(self.conn.get_addresses(aliases),
+                             {'AlIaS3@aLiAs.CoM': 'foo3@foobar.com', 'alias1@alias.com': 'foo1@foobar.com'})
+        with self.subTest(test_number=1):
+            # more aliases than variables per query
+            aliases = ['alias{0}@alias.com'.format(i) for i in range(DBClass.MAX_VARIABLES * 2 + 1)]
+            self.assertEqual(set(self.conn.get_addresses(aliases)), {'alias1@alias.com', 'alias2@alias.com',
+                                                                     'alias3@alias.com', 'alias4@alias.com'})
+        with self.subTest(test_number=2):
+            self.assertEqual(self.conn.get_addresses([]), {})
+
+    def test_sync_state(self):
+        with self.subTest(test_number=0):
+            self.assertIsNone(self.conn.get_sync_state('INBOX'))
+        self.conn.set_sync_state('INBOX', 1234, 10)
+        self.conn.set_sync_state('INBOX', 1234, 20)
+        with self.subTest(test_number=1):
+            self.assertEqual(self.conn.get_sync_state('INBOX'), (1234, 20))
+
+    def test_import_checkpoint(self):
+        today = date.today().strftime('%Y-%m-%d')
+        result = self.conn.add_aliases_bulk([('foo1@foobar.com', 'new1@alias.com')], today,
+                                            checkpoint=('import.csv', 'abc', 42))
+        with self.subTest(test_number=0):
+            self.assertEqual(result.inserted, 1)
+        with self.subTest(test_number=1):
+            self.assertEqual(self.conn.get_import_offset('import.csv', 'abc'), 42)
+        with self.subTest(test_number=2):
+            # a different file with the same name is imported from the start
+            self.assertEqual(self.conn.get_import_offset('import.csv', 'xyz'), 0)
+        self.conn.clear_import_checkpoint('import.csv')
+        with self.subTest(test_number=3):
+            self.assertEqual(self.conn.get_import_offset('import.csv', 'abc'), 0)
+
+    def test_get_address_uses_index(self):
+        plan = self.conn.conn.execute(f'EXPLAIN QUERY PLAN SELECT email FROM {self.table} WHERE alias = ?',
+                                      ('AlIaS3@aLiAs.CoM',)).fetchall()
+        self.assertIn('USING INDEX', plan[0][-1])
+
+    def test_case_insensitive_duplicate(self):
+        self.conn.add_alias('foo1@foobar.com', 'Alias1@alias.com', date.today().strftime('%Y-%m-%d'))
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.add_alias('foo2@foobar.com', 'ALIAS1@alias.com', date.today().strftime('%Y-%m-%d'))
+
+    def test_migrate(self):
+        # table as created by older versions with a case sensitive primary key
+        self.conn.close()
+        Path(DATA_DIR, 'test.db').unlink()
+        conn = sqlite3.connect(Path(DATA_DIR, 'test.db'))
+        with conn:
+            conn.execute('CREATE TABLE alias (email text, alias text primary key, date date_column)')
+            conn.executemany('INSERT INTO alias VALUES(?, ?, ?)',
+                             [('foo1@foobar.com', 'Alias1@alias.com', '2022-05-01'),
+                              ('foo2@foobar.com', 'ALIAS1@alias.com', '2022-05-02'),
+                              ('foo3@foobar.com', 'alias3@alias.com', '2022-05-03')])
+        conn.close()
+
+        self.conn = DBClass(Path(DATA_DIR, 'test.db'), self.table)
+        with self.subTest(test_number=0):
+            self.assertEqual(self.conn.get_address('alias1@ALIAS.com'), 'foo1@foobar.com')
+            self.assertEqual(self.conn.get_address('ALIAS3@alias.com'), 'foo3@foobar.com')
+        with self.subTest(test_number=1):
+            # aliases that only differ in case have been merged
+            self.assertEqual(self.conn.conn.execute('SELECT count(*) FROM alias').fetchone()[0], 2)
+        with self.subTest(test_number=2):
+            self.test_get_address_uses_index()
+
     def test_purge_old_entries(self):
         delta = [0, 5, 40, 10]
         import_file = Path(DATA_DIR, 'valid_data.csv')
@@ -132,6 +247,597 @@ class TestDBClass(TestCase):
             # no row should have been deleted
             self.assertEqual(0, self.conn.purge_old_entries())
 
+    def test_purge_old_entries_batched(self):
+        self.conn.purge_batch_size = 2
+        today_ = date.today()
+        rows = [('foo{0}@foobar.com'.format(i), 'alias{0}@alias.com'.format(i),
+                 (today_ - timedelta(70 if i < 5 else 0)).strftime('%Y-%m-%d')) for i in range(8)]
+        with self.conn.conn:
+            self.conn.conn.executemany(f'INSERT INTO {self.table} VALUES(?, ?, ?)', rows)
+        with self.subTest(test_number=0):
+            # 5 rows in batches of 2
+            self.assertEqual(5, self.conn.purge_old_entries())
+        with self.subTest(test_number=1):
+            self.assertEqual(self.conn.conn.execute(f'SELECT count(*) FROM {self.table}').fetchone()[0], 3)
+        with self.subTest(test_number=2):
+            plan = self.conn.conn.execute(f'EXPLAIN QUERY PLAN SELECT rowid FROM {self.table} '
+                                          f'WHERE date <= date("now", "-60 day")').fetchall()
+            self.assertIn('USING', plan[0][-1])
+            self.assertIn('INDEX', plan[0][-1])
+
+
+class FakeClock:
+    """clock that only moves if told so"""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.metrics = Metrics(('sent', 'failed'), clock=self.clock)
+
+    def tearDown(self) -> None:
+        for file_name in ['metrics.json', 'metrics.prom']:
+            Path(DATA_DIR, file_name).unlink(missing_ok=True)
+
+    def record(self):
+        with self.metrics.timer('fetch'):
+            self.clock.now += 2
+        for _ in self.metrics.timed(range(3), 'parse'):
+            self.clock.now += 1
+        self.metrics.add_time('fetch', 1)
+        self.metrics.count('sent', 2)
+        self.metrics.add_bytes('fetched', 1024)
+
+    def test_summary(self):
+        self.record()
+        summary = self.metrics.summary()
+        with self.subTest(test_number=0):
+            self.assertEqual(summary['duration'], 5)
+            self.assertEqual(summary['timers'], {'fetch': 3, 'parse': 0})
+            self.assertEqual(summary['counters'], {'sent': 2, 'failed': 0})
+            self.assertEqual(summary['bytes'], {'fetched': 1024})
+        with self.subTest(test_number=1):
+            self.metrics.reset()
+            self.assertEqual(self.metrics.summary()['counters'], {'sent': 0, 'failed': 0})
+            self.assertEqual(self.metrics.summary()['timers'], {})
+
+    def test_write_json(self):
+        self.record()
+        json_file = Path(DATA_DIR, 'metrics.json')
+        self.metrics.write_json(json_file)
+        self.metrics.write_json(json_file)
+        lines = json_file.read_text().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])['counters'], {'sent': 2, 'failed': 0})
+
+    def test_write_prometheus(self):
+        self.record()
+        prom_file = Path(DATA_DIR, 'metrics.prom')
+        self.metrics.write_prometheus(prom_file, prefix='test')
+        lines = prom_file.read_text().splitlines()
+        with self.subTest(test_number=0):
+            self.assertIn('test_stage_seconds{stage="fetch"} 3', lines)
+            self.assertIn('test_messages{result="failed"} 0', lines)
+            self.assertIn('test_bytes{direction="fetched"} 1024', lines)
+        with self.subTest(test_number=1):
+            # temporary file has been renamed
+            self.assertEqual([path.name for path in Path(DATA_DIR).glob('metrics.prom*')], ['metrics.prom'])
+
+
+class TestAliasCache(TestCase):
+
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.cache = AliasCache(max_size=2, ttl=100, negative_ttl=10, clock=self.clock)
+
+    def test_ttl(self):
+        self.cache.put('Alias1@alias.com', 'foo1@foobar.com')
+        self.cache.put('unknown@alias.com', None)
+        with self.subTest(test_number=0):
+            self.assertEqual(self.cache.get('ALIAS1@alias.com'), 'foo1@foobar.com')
+            self.assertIsNone(self.cache.get('unknown@alias.com'))
+        self.clock.now = 10
+        with self.subTest(test_number=1):
+            # negative entry expired
+            self.assertIs(self.cache.get('unknown@alias.com'), AliasCache.MISSING)
+            self.assertEqual(self.cache.get('alias1@alias.com'), 'foo1@foobar.com')
+        self.clock.now = 100
+        with self.subTest(test_number=2):
+            self.assertIs(self.cache.get('alias1@alias.com'), AliasCache.MISSING)
+        with self.subTest(test_number=3):
+            self.assertEqual(self.cache.stats(), {'size': 0, 'hits': 3, 'misses': 2, 'evictions': 0})
+
+    def test_lru(self):
+        self.cache.put('alias1@alias.com', 'foo1@foobar.com')
+        self.cache.put('alias2@alias.com', 'foo2@foobar.com')
+        # alias1 becomes most recently used, alias2 is evicted
+        self.cache.get('alias1@alias.com')
+        self.cache.put('alias3@alias.com', 'foo3@foobar.com')
+        self.assertIs(self.cache.get('alias2@alias.com'), AliasCache.MISSING)
+        self.assertEqual(self.cache.get('alias1@alias.com'), 'foo1@foobar.com')
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_db_invalidation(self):
+        conn = DBClass(':memory:', 'alias', cache=self.cache)
+        today_ = date.today().strftime('%Y-%m-%d')
+        with self.subTest(test_number=0):
+            self.assertIsNone(conn.get_address('alias1@alias.com'))
+        conn.add_alias('foo1@foobar.com', 'Alias1@alias.com', today_)
+        with self.subTest(test_number=1):
+            self.assertEqual(conn.get_address('alias1@alias.com'), 'foo1@foobar.com')
+        self.assertIsNone(conn.get_address('alias2@alias.com'))
+        conn.add_aliases_bulk([['foo2@foobar.com', 'alias2@alias.com']], today_)
+        with self.subTest(test_number=2):
+            self.assertEqual(conn.get_address('alias2@alias.com'), 'foo2@foobar.com')
+            self.assertEqual(conn.get_addresses(['alias1@alias.com', 'unknown@alias.com']),
+                             {'alias1@alias.com': 'foo1@foobar.com'})
+        conn.conn.execute("UPDATE alias SET date = '2000-01-01'")
+        conn.purge_old_entries()
+        with self.subTest(test_number=3):
+            self.assertIsNone(conn.get_address('alias1@alias.com'))
+        conn.close()
+
+
+class FakeIMAPSession:
+    """stands in for imaplib.IMAP4 and records the issued commands"""
+    def __init__(self, messages, capabilities=('IMAP4REV1',)):
+        self.messages = messages
+        self.capabilities = capabilities
+        self.commands = []
+
+    def fetch(self, message_set, message_parts):
+        self.commands.append(('FETCH', message_set, message_parts))
+        data = []
+        for msg_id in message_set.split(','):
+            raw = self.messages[msg_id]
+            data.append(('{0} {1} {{{2}}}'.format(msg_id, message_parts, len(raw)).encode(), raw))
+            data.append(b')')
+        return 'OK', data
+
+    def store(self, message_set, command, flags):
+        self.commands.append(('STORE', message_set, command, flags))
+        return 'OK', [None]
+
+    def login(self, username, password):
+        # like Dovecot, more capabilities are available after authentication
+        self.authenticated_capabilities = b'IMAP4rev1 IDLE UIDPLUS'
+        return 'OK', [b'Logged in']
+
+    def capability(self):
+        return 'OK', [getattr(self, 'authenticated_capabilities', ' '.join(self.capabilities).encode())]
+
+    def search(self, charset, criterion):
+        self.commands.append(('SEARCH', criterion))
+        return 'OK', [' '.join(self.messages).encode()]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH' and args[0].startswith('UID '):
+            self.commands.append(('UID', command) + args)
+            first = int(args[0].split()[1].split(':')[0])
+            # n:* contains the highest UID even if it is below n
+            uids = [uid for uid in self.messages if int(uid) >= first] or [max(self.messages, key=int)]
+            return 'OK', [' '.join(uids).encode()]
+        if command == 'SEARCH':
+            return self.search(None, *args)
+        self.commands.append(('UID', command) + args)
+        if command == 'FETCH':
+            data = []
+            for seq, uid in enumerate(args[0].split(','), 1):
+                raw = self.messages[uid]
+                data.append(('{0} (UID {1} {2} {{{3}}}'.format(seq, uid, args[1], len(raw)).encode(), raw))
+                data.append(b')')
+            return 'OK', data
+        return 'OK', [None]
+
+
+class TestIMAP_Class(TestCase):
+
+    def setUp(self) -> None:
+        self.messages = {str(i): 'message {0}'.format(i).encode() for i in range(1, 8)}
+        self.session = FakeIMAPSession(self.messages)
+        # bypass __init__ as it would connect to a server
+        self.imap = IMAP_Class.__new__(IMAP_Class)
+        self.imap.session = self.session
+
+    def test_message_set(self):
+        self.assertEqual(IMAP_Class.message_set([b'1', b'2', b'5']), '1,2,5')
+        self.assertEqual(IMAP_Class.message_set([3, '4']), '3,4')
+
+    def test_sequence_set(self):
+        test_values = [([b'1', b'2', b'3', b'5'], '1:3,5'),
+                       ([5, '3', b'4', 1], '1,3:5'),
+                       ([b'7'], '7'),
+                       ([], '')]
+        for i, (msg_ids, sequence_set) in enumerate(test_values):
+            with self.subTest(test_number=i):
+                self.assertEqual(IMAP_Class.sequence_set(msg_ids), sequence_set)
+
+    def test_trash_mails(self):
+        IMAP_Class.retention_period = 60
+        with self.subTest(test_number=0):
+            self.assertEqual(self.imap.trash_mails(batch_size=5), 7)
+            self.assertEqual([command for command in self.session.commands if command[0] != 'SEARCH'],
+                             [('STORE', '1:5', '+FLAGS', '\\Deleted'), ('STORE', '6:7', '+FLAGS', '\\Deleted')])
+        with self.subTest(test_number=1):
+            # UIDs and UID EXPUNGE if the server supports UIDPLUS
+            self.session.capabilities = ('IMAP4REV1', 'UIDPLUS')
+            self.session.commands = []
+            self.assertEqual(self.imap.trash_mails(), 7)
+            self.assertEqual([command for command in self.session.commands if command[0] != 'SEARCH'],
+                             [('UID', 'STORE', '1:7', '+FLAGS', '\\Deleted'), ('UID', 'EXPUNGE', '1:7')])
+
+    def test_capabilities_after_login(self):
+        self.imap.username = 'valid_username'
+        self.imap.password = 'valid_password'
+        self.imap.login()
+        with self.subTest(test_number=0):
+            self.assertEqual(self.session.capabilities, ('IMAP4REV1', 'IDLE', 'UIDPLUS'))
+        IMAP_Class.retention_period = 60
+        self.imap.trash_mails()
+        with self.subTest(test_number=1):
+            # UIDPLUS advertised only after login is used
+            self.assertIn(('UID', 'EXPUNGE', '1:7'), self.session.commands)
+
+    def test_fetch_messages(self):
+        msg_ids = [str(i).encode() for i in range(1, 8)]
+        fetched = list(self.imap.fetch_messages(msg_ids, chunk_size=3))
+        with self.subTest(test_number=0):
+            self.assertEqual(fetched, [(msg_id, self.messages[msg_id.decode()]) for msg_id in msg_ids])
+        with self.subTest(test_number=1):
+            # 7 messages in chunks of 3 -> 3 FETCH commands
+            self.assertEqual([command[1] for command in self.session.commands], ['1,2,3', '4,5,6', '7'])
+
+    def test_get_new_uids(self):
+        self.imap.uidvalidity = 1234
+        self.imap.uidnext = 6
+        with self.subTest(test_number=0):
+            # unknown UIDVALIDITY -> full resync
+            self.assertEqual(self.imap.get_new_uids(), [str(i).encode() for i in range(1, 8)])
+            self.assertEqual(self.imap.high_water_mark, 7)
+        with self.subTest(test_number=1):
+            self.assertEqual(self.imap.get_new_uids(1234, 4), [b'5', b'6', b'7'])
+            self.assertEqual(self.session.commands[-1], ('UID', 'SEARCH', 'UID 5:*'))
+            self.assertEqual(self.imap.high_water_mark, 7)
+        with self.subTest(test_number=2):
+            # no new messages
+            self.assertEqual(self.imap.get_new_uids(1234, 7), [])
+            self.assertEqual(self.imap.high_water_mark, 7)
+        with self.subTest(test_number=3):
+            self.assertEqual(self.imap.get_new_uids(1111, 7), [str(i).encode() for i in range(1, 8)])
+
+    def test_get_new_uids_without_uidnext(self):
+        self.imap.uidvalidity = 1234
+        self.imap.uidnext = None
+        with self.subTest(test_number=0):
+            # the seen messages must not be reprocessed on the next run
+            self.session.search = lambda charset, criterion: ('OK', [b'2 3'] if criterion == 'NOT SEEN' else
+                                                              [b'1 2 3 5 9'])
+            self.assertEqual(self.imap.get_new_uids(), [b'2', b'3'])
+            self.assertEqual(self.imap.high_water_mark, 9)
+        with self.subTest(test_number=1):
+            # empty folder
+            self.session.search = lambda charset, criterion: ('OK', [b''])
+            self.assertEqual(self.imap.get_new_uids(), [])
+            self.assertEqual(self.imap.high_water_mark, 0)
+
+    def test_fetch_messages_uid(self):
+        self.imap.use_uid = True
+        with self.subTest(test_number=0):
+            fetched = list(self.imap.fetch_messages([b'5', b'7']))
+            self.assertEqual(fetched, [(b'5', b'message 5'), (b'7', b'message 7')])
+            self.assertEqual(self.session.commands, [('UID', 'FETCH', '5,7', '(RFC822)')])
+        with self.subTest(test_number=1):
+            # UID after the message data
+            self.session.uid = lambda *args: ('OK', [(b'1 (RFC822 {9}', b'message 5'), b' UID 5)'])
+            self.assertEqual(list(self.imap.fetch_messages([b'5'])), [(b'5', b'message 5')])
+        with self.subTest(test_number=2):
+            del self.session.uid
+            self.session.commands = []
+            self.imap.mark_seen([b'5'])
+            self.assertEqual(self.session.commands, [('UID', 'STORE', '5', '+FLAGS', '\\Seen')])
+
+    def test_mark_seen(self):
+        self.imap.mark_seen([b'1', b'2', b'3'], chunk_size=2)
+        self.assertEqual(self.session.commands, [('STORE', '1,2', '+FLAGS', '\\Seen'),
+                                                 ('STORE', '3', '+FLAGS', '\\Seen')])
+        # nothing to do for an empty list
+        self.session.commands = []
+        self.imap.mark_seen([])
+        self.assertEqual(self.session.commands, [])
+
+
+class FakeIDLESession:
+    """imaplib.IMAP4 stand-in for IDLE that talks to a fake server via a socket pair"""
+    def __init__(self, capabilities=('IMAP4REV1', 'IDLE')):
+        self.capabilities = capabilities
+        self.sock, self.server = socket.socketpair()
+        self.file = self.sock.makefile('rb')
+        self.noops = 0
+        self.tagged_commands = {}
+
+    def _new_tag(self):
+        # registered like imaplib does
+        self.tagged_commands[b'A001'] = None
+        return b'A001'
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+    def noop(self):
+        self.noops += 1
+        return 'OK', [b'NOOP completed']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+        self.server.close()
+
+
+class TestIMAP_Class_IDLE(TestCase):
+
+    def setUp(self) -> None:
+        self.session = FakeIDLESession()
+        # bypass __init__ as it would connect to a server
+        self.imap = IMAP_Class.__new__(IMAP_Class)
+        self.imap.session = self.session
+
+    def tearDown(self) -> None:
+        self.session.close()
+
+    def answer_done(self):
+        """fake server: waits for DONE and confirms the end of IDLE"""
+        received = b''
+        while b'DONE' not in received:
+            received += self.session.server.recv(1024)
+        self.session.server.sendall(b'A001 OK IDLE terminated\r\n')
+
+    def test_new_mail(self):
+        self.session.server.sendall(b'+ idling\r\n* 5 EXISTS\r\n')
+        server = threading.Thread(target=self.answer_done)
+        server.start()
+        self.assertTrue(self.imap.idle(timeout=5))
+        server.join()
+        # the tag isn't kept for the lifetime of the session
+        self.assertEqual(self.session.tagged_commands, {})
+
+    def test_timeout(self):
+        self.session.server.sendall(b'+ idling\r\n')
+        server = threading.Thread(target=self.answer_done)
+        server.start()
+        self.assertFalse(self.imap.idle(timeout=0.2))
+        server.join()
+
+    def test_noop_fallback(self):
+        self.session.capabilities = ('IMAP4REV1',)
+        self.assertTrue(self.imap.idle(timeout=0))
+        self.assertEqual(self.session.noops, 1)
+
+    def test_new_import_file(self):
+        self.session.server.sendall(b'+ idling\r\n')
+        server = threading.Thread(target=self.answer_done)
+        server.start()
+        with tempfile.TemporaryDirectory() as directory:
+            watcher = DirectoryWatcher(directory)
+            threading.Timer(0.2, Path(directory, 'batch.csv').write_text, ('foo@foobar.com,alias@alias.com\n',)).start()
+            start = time.monotonic()
+            self.assertFalse(self.imap.idle(timeout=5, watcher=watcher))
+            watcher.close()
+        server.join()
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class TestDirectoryWatcher(TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def check_watcher(self, watcher):
+        with self.subTest(test_number=0):
+            self.assertFalse(watcher.changed())
+        # written under a temporary name and renamed
+        Path(self.directory.name, '.batch.csv').write_text('foo@foobar.com,alias@alias.com\n')
+        with self.subTest(test_number=1):
+            self.assertFalse(watcher.wait(0.1))
+        Path(self.directory.name, '.batch.csv').rename(Path(self.directory.name, 'batch.csv'))
+        with self.subTest(test_number=2):
+            self.assertTrue(watcher.wait(2))
+        Path(self.directory.name, 'notes.txt').write_text('foo')
+        with self.subTest(test_number=3):
+            self.assertFalse(watcher.wait(0.1))
+        watcher.close()
+
+    def test_inotify(self):
+        self.check_watcher(DirectoryWatcher(self.directory.name))
+
+    def test_polling(self):
+        watcher = DirectoryWatcher(self.directory.name, poll_interval=0.05, use_inotify=False)
+        self.assertIsNone(watcher.fileno())
+        self.check_watcher(watcher)
+
+
+class FakeSMTPSession:
+    """stands in for smtplib.SMTP, optionally drops the connection before the first message"""
+    def __init__(self, disconnect=False):
+        self.disconnect = disconnect
+        self.logins = 0
+        self.sent = []
+
+    def login(self, username, password):
+        self.logins += 1
+
+    def sendmail(self, from_address, to_address, message):
+        if self.disconnect:
+            self.disconnect = False
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append((from_address, to_address, message))
+
+    def noop(self):
+        if self.disconnect:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return 250, b'OK'
+
+    def quit(self):
+        pass
+
+
+class TestSMTP_Class(TestCase):
+
+    def setUp(self) -> None:
+        self.sessions = []
+        # bypass __init__ as it would connect to a server
+        self.smtp = SMTP_Class.__new__(SMTP_Class)
+        self.smtp.username = 'valid_username'
+        self.smtp.password = 'valid_password'
+        self.smtp.sent_count = 0
+        self.smtp.connect = self.connect
+        self.smtp.connect()
+
+    def connect(self, disconnect=False):
+        self.smtp.session = FakeSMTPSession(disconnect)
+        self.smtp._logged_in = False
+        self.sessions.append(self.smtp.session)
+
+    def test_single_login(self):
+        for i in range(3):
+            self.smtp.send_message('from@example.com', ['to@example.com'], 'message {0}'.format(i))
+        with self.subTest(test_number=0):
+            self.assertEqual(self.sessions[0].logins, 1)
+        with self.subTest(test_number=1):
+            self.assertEqual(self.smtp.sent_count, 3)
+
+    def test_reconnect(self):
+        self.sessions[0].disconnect = True
+        self.smtp.send_message('from@example.com', ['to@example.com'], 'message')
+        with self.subTest(test_number=0):
+            # a new session has been opened and authenticated
+            self.assertEqual(len(self.sessions), 2)
+            self.assertEqual(self.sessions[1].logins, 1)
+        with self.subTest(test_number=1):
+            self.assertEqual(self.sessions[1].sent, [('from@example.com', ['to@example.com'], 'message')])
+            self.assertEqual(self.smtp.sent_count, 1)
+
+    def test_keep_alive(self):
+        self.smtp.login()
+        self.smtp.keep_alive()
+        with self.subTest(test_number=0):
+            self.assertEqual(len(self.sessions), 1)
+        self.sessions[0].disconnect = True
+        self.smtp.keep_alive()
+        with self.subTest(test_number=1):
+            # closed by the server -> reconnected and authenticated again
+            self.assertEqual(len(self.sessions), 2)
+            self.assertEqual(self.sessions[1].logins, 1)
+
+
+class FakeSMTPClass:
+    """stands in for SMTP_Class, messages to 'fail@example.com' are rejected"""
+    instances = []
+
+    def __init__(self):
+        self.sent_count = 0
+        self.resets = 0
+        self.keep_alives = 0
+        self.closed = False
+        FakeSMTPClass.instances.append(self)
+
+    def login(self):
+        pass
+
+    def send_message(self, from_address, to_address, message):
+        if 'fail@example.com' in to_address:
+            raise smtplib.SMTPRecipientsRefused({'fail@example.com': (550, b'unknown user')})
+        self.sent_count += 1
+
+    def reset(self):
+        self.resets += 1
+
+    def keep_alive(self):
+        self.keep_alives += 1
+
+    def quit(self):
+        self.closed = True
+
+
+class TestSMTP_Pool(TestCase):
+
+    def setUp(self) -> None:
+        FakeSMTPClass.instances = []
+        import_file = Path(DATA_DIR, 'test_subject.eml')
+        with import_file.open('rb') as file:
+            file_content = file.read()
+        self.messages = []
+        for i in range(6):
+            message = Message(file_content)
+            message.TO_address = 'fail@example.com' if i == 3 else 'to{0}@example.com'.format(i)
+            self.messages.append(message)
+
+    def test_send_messages(self):
+        pool = SMTP_Pool(FakeSMTPClass, size=2)
+        results = list(pool.send_messages(self.messages))
+        with self.subTest(test_number=0):
+            # one result per message in the order of the messages
+            self.assertEqual([result.message for result in results], self.messages)
+        with self.subTest(test_number=1):
+            self.assertEqual([result.error is None for result in results], [True, True, True, False, True, True])
+        with self.subTest(test_number=2):
+            self.assertLessEqual(len(FakeSMTPClass.instances), 2)
+            self.assertEqual(sum(smtp.sent_count for smtp in FakeSMTPClass.instances), 5)
+            self.assertEqual(sum(smtp.resets for smtp in FakeSMTPClass.instances), 1)
+
+    def test_lazy_consumption(self):
+        pool = SMTP_Pool(FakeSMTPClass, size=1)
+        consumed = []
+
+        def messages():
+            for message in self.messages:
+                consumed.append(message)
+                yield message
+
+        results = pool.send_messages(messages())
+        next(results)
+        # at most two messages per session have been read ahead
+        self.assertEqual(len(consumed), 2)
+        self.assertEqual(len(list(results)), 5)
+
+    def test_keep_alive(self):
+        pool = SMTP_Pool(FakeSMTPClass, size=1)
+        pool.send(self.messages[0])
+        pool.send(self.messages[1])
+        with self.subTest(test_number=0):
+            # reused right away -> no NOOP
+            self.assertEqual(FakeSMTPClass.instances[0].keep_alives, 0)
+        pool.keep_alive_interval = 0
+        pool.send(self.messages[2])
+        with self.subTest(test_number=1):
+            self.assertEqual(len(FakeSMTPClass.instances), 1)
+            self.assertEqual(FakeSMTPClass.instances[0].keep_alives, 1)
+
+    def test_max_messages(self):
+        pool = SMTP_Pool(FakeSMTPClass, size=1, max_messages=2)
+        del self.messages[3]
+        results = list(pool.send_messages(self.messages))
+        with self.subTest(test_number=0):
+            self.assertTrue(all(result.error is None for result in results))
+        with self.subTest(test_number=1):
+            # 5 messages with max 2 per session -> 3 sessions, the first two have been terminated
+            self.assertEqual([smtp.sent_count for smtp in FakeSMTPClass.instances], [2, 2, 1])
+            self.assertEqual([smtp.closed for smtp in FakeSMTPClass.instances], [True, True, False])
+        pool.quit()
+        with self.subTest(test_number=2):
+            self.assertTrue(FakeSMTPClass.instances[2].closed)
+
 
 class TestMessage(TestCase):
 
@@ -159,6 +865,25 @@ class TestMessage(TestCase):
         with self.subTest(test_number=1):
             self.assertEqual(self.test_message.FROM_address, 'fritz_fuchs@bauwagen.de')
 
+    def test_header_fields_only(self):
+        """checks must work on the header fields returned by a BODY.PEEK[HEADER.FIELDS ...] fetch"""
+        import_file = Path(DATA_DIR, 'test_subject_fail.eml')
+        with import_file.open('rb') as file:
+            headers = email.message_from_binary_file(file)
+        raw_headers = ''.join('{0}: {1}\r\n'.format(field, headers[field])
+                              for field in ('To', 'From', 'Received-SPF')).encode() + b'\r\n'
+        Message.check_spf = True
+        Message.whitelist = ['example.com']
+        self.test_message = Message(raw_headers)
+        with self.subTest(test_number=0):
+            self.assertEqual(self.test_message.TO_address, 'testemail@example.com')
+        with self.subTest(test_number=1):
+            self.assertEqual(self.test_message.domain_whitelisted, True)
+        with self.subTest(test_number=2):
+            self.assertEqual(self.test_message.spf_status, False)
+        Message.check_spf = False
+        Message.whitelist = []
+
     def test_bcc_address(self):
         import_file = Path(DATA_DIR, 'test_subject.eml')
         with import_file.open('rb') as file:
@@ -222,6 +947,19 @@ class TestMessage(TestCase):
         with self.subTest(test_number=5):
             self.assertEqual(self.test_message.spf_status, True)
 
+    def test_spf_headers(self):
+        Message.check_spf = True
+        header = 'To: testemail@example.com\r\nFrom: paul_positive@example.com\r\n'
+        test_values = [('', True),
+                       ('Received-SPF: fail (example.com: none)\r\n', False),
+                       ('Received-SPF: Pass (example.com)\r\nReceived-SPF: fail (example.com)\r\n', True),
+                       ('Received-SPF: fail (example.com)\r\nReceived-SPF: pass (example.com)\r\n', False)]
+        for i, (spf_headers, spf_status) in enumerate(test_values):
+            with self.subTest(test_number=i):
+                self.test_message = Message((header + spf_headers + '\r\nTest body').encode())
+                self.assertEqual(self.test_message.spf_status, spf_status)
+        Message.check_spf = False
+
     def test_domain_whitelisted(self):
         import_file = Path(DATA_DIR, 'test_subject.eml')
         with import_file.open('rb') as file:
@@ -251,6 +989,202 @@ class TestMessage(TestCase):
             self.assertEqual(self.test_message.domain_whitelisted, False)
 
 
+class TestWhitelistMatcher(TestCase):
+
+    def setUp(self) -> None:
+        self.matcher = WhitelistMatcher(['dhl.de', '*.dpd.de', 'Parcel.One'])
+
+    def test_get_domain(self):
+        test_values = [('noreply@dhl.de', 'dhl.de'),
+                       ('DHL Paket <noreply@DHL.de>', 'dhl.de'),
+                       ('"Paket, DHL" <noreply@dhl.de>', 'dhl.de'),
+                       ('DHL Paket', None),
+                       ('', None),
+                       (None, None)]
+        for i, (from_address, domain) in enumerate(test_values):
+            with self.subTest(test_number=i):
+                self.assertEqual(WhitelistMatcher.get_domain(from_address), domain)
+
+    def test_match(self):
+        test_values = [('noreply@dhl.de', True),
+                       ('noreply@paket.dhl.de', False),
+                       ('noreply@paket.dpd.de', True),
+                       ('noreply@a.service.dpd.de', True),
+                       ('noreply@dpd.de', False),
+                       ('noreply@fakedpd.de', False),
+                       ('noreply@parcel.one', True),
+                       ('Spam', False)]
+        for i, (from_address, whitelisted) in enumerate(test_values):
+            with self.subTest(test_number=i):
+                self.assertEqual(self.matcher.match(from_address), whitelisted)
+
+    def test_stats(self):
+        for from_address in ['noreply@dhl.de', 'info@dhl.de', 'noreply@paket.dpd.de', 'spam@foobar.com', 'Spam']:
+            self.matcher.match(from_address)
+        self.assertEqual(self.matcher.stats(), {'matches': {'dhl.de': 2, 'paket.dpd.de': 1},
+                                                'rejects': {'foobar.com': 1, None: 1}})
+
+    def test_stats_reset(self):
+        self.matcher.match('spam@foobar.com')
+        with self.subTest(test_number=0):
+            self.assertEqual(self.matcher.stats(reset=True), {'matches': {}, 'rejects': {'foobar.com': 1}})
+        with self.subTest(test_number=1):
+            self.assertEqual(self.matcher.stats(), {'matches': {}, 'rejects': {}})
+
+    def test_message_matcher(self):
+        Message.whitelist = ['example.com']
+        matcher = Message.whitelist_matcher()
+        with self.subTest(test_number=0):
+            # compiled only once
+            self.assertIs(Message.whitelist_matcher(), matcher)
+        with self.subTest(test_number=1):
+            # compiled again for a new whitelist
+            Message.whitelist = ['*.example.com']
+            self.assertIsNot(Message.whitelist_matcher(), matcher)
+        with self.subTest(test_number=2):
+            message = Message(b'To: testemail@example.com\r\nFrom: Paul <paul@mail.example.com>\r\n\r\nTest body')
+            self.assertEqual(message.domain_whitelisted, True)
+        with self.subTest(test_number=3):
+            # no address in From header
+            message = Message(b'To: testemail@example.com\r\nFrom: Paul\r\n\r\nTest body')
+            self.assertEqual(message.domain_whitelisted, False)
+        Message.whitelist = []
+
+
+class TestCheckWorker(TestCase):
+
+    def setUp(self) -> None:
+        self.raw_messages = {}
+        for i, file_name in enumerate(['test_subject.eml', 'test_subject_fail.eml']):
+            import_file = Path(DATA_DIR, file_name)
+            with import_file.open('rb') as file:
+                self.raw_messages[str(i + 1).encode()] = file.read()
+
+    def test_check_raw_message(self):
+        result = check_raw_message(b'1', self.raw_messages[b'1'])
+        self.assertEqual(result, CheckResult(b'1', 'Paul Positiv <paul_positive@example.com>',
+                                             'testemail@example.com', True, True))
+
+    def test_worker_processes(self):
+        with ProcessPoolExecutor(2, initializer=init_worker, initargs=(True, ['foobar.com'])) as executor:
+            results = list(executor.map(check_raw_message, self.raw_messages, self.raw_messages.values()))
+        with self.subTest(test_number=0):
+            self.assertEqual([result.msg_id for result in results], [b'1', b'2'])
+        with self.subTest(test_number=1):
+            # configuration of the main process is used by the workers
+            self.assertEqual([result.spf_status for result in results], [True, False])
+            self.assertEqual([result.domain_whitelisted for result in results], [False, False])
+
+
+class TestLazyMessage(TestCase):
+
+    def setUp(self) -> None:
+        import_file = Path(DATA_DIR, 'test_subject.eml')
+        with import_file.open('rb') as file:
+            self.file_content = file.read()
+
+    def test_lazy_parsing(self):
+        self.test_message = LazyMessage(self.file_content)
+        with self.subTest(test_number=0):
+            self.assertEqual(self.test_message.TO_address, 'testemail@example.com')
+            self.assertEqual(self.test_message.FROM_address, 'Paul Positiv <paul_positive@example.com>')
+        with self.subTest(test_number=1):
+            # body hasn't been parsed
+            self.assertIsNone(self.test_message._message)
+            self.assertEqual(self.test_message.headers.get_payload(), '')
+        with self.subTest(test_number=2):
+            self.assertFalse(hasattr(self.test_message, '__dict__'))
+
+    def test_message_as_string(self):
+        self.test_message = LazyMessage(self.file_content)
+        self.test_message.TO_address = 'fritz_fuchs@bauwagen.de'
+        self.test_message.FROM_address = 'foo@foobar.com'
+        message = Message(self.file_content)
+        message.TO_address = 'fritz_fuchs@bauwagen.de'
+        message.FROM_address = 'foo@foobar.com'
+        self.assertEqual(self.test_message.message_as_string, message.message_as_string)
+
+    def test_checks(self):
+        Message.check_spf = True
+        Message.whitelist = ['example.com']
+        for i, (file_name, spf_status) in enumerate([('test_subject.eml', True), ('test_subject_fail.eml', False)]):
+            import_file = Path(DATA_DIR, file_name)
+            with import_file.open('rb') as file:
+                self.test_message = LazyMessage(file.read())
+            with self.subTest(test_number=i):
+                self.assertEqual(self.test_message.spf_status, spf_status)
+                self.assertEqual(self.test_message.domain_whitelisted, True)
+        Message.check_spf = False
+        Message.whitelist = []
+
+    def test_message_as_bytes(self):
+        self.test_message = LazyMessage(self.file_content)
+        self.test_message.TO_address = 'fritz_fuchs@bauwagen.de'
+        self.test_message.FROM_address = 'foo@foobar.com'
+        raw = self.test_message.message_as_bytes
+        with self.subTest(test_number=0):
+            # only To and From lines differ
+            changed = set(raw.splitlines()) ^ set(self.file_content.splitlines())
+            self.assertEqual(changed, {b'To: testemail@example.com', b'From: Paul Positiv <paul_positive@example.com>',
+                                       b'To: fritz_fuchs@bauwagen.de', b'From: foo@foobar.com'})
+        with self.subTest(test_number=1):
+            message = email.message_from_bytes(raw)
+            self.assertEqual(message['To'], 'fritz_fuchs@bauwagen.de')
+            self.assertEqual(message['From'], 'foo@foobar.com')
+            self.assertEqual(message.get_payload(), Message(self.file_content).message.get_payload())
+        with self.subTest(test_number=2):
+            # MIME tree hasn't been built
+            self.assertIsNone(self.test_message._message)
+
+    def test_message_as_bytes_non_ascii_name(self):
+        self.test_message = LazyMessage(self.file_content)
+        self.test_message.TO_address = 'fritz_fuchs@bauwagen.de'
+        self.test_message.FROM_address = 'Müller Versand <versand@example.de>'
+        message = email.message_from_bytes(self.test_message.message_as_bytes)
+        with self.subTest(test_number=0):
+            self.assertEqual(message['From'], '=?utf-8?q?M=C3=BCller_Versand?= <versand@example.de>')
+        with self.subTest(test_number=1):
+            # the address stays readable for the smtp envelope and the recipient's client
+            self.assertEqual(email.utils.getaddresses([message['From']])[0][1], 'versand@example.de')
+        with self.subTest(test_number=2):
+            self.assertEqual(str(email.header.make_header(email.header.decode_header(message['From']))),
+                             'Müller Versand <versand@example.de>')
+
+    def test_message_as_bytes_long_name(self):
+        raw = self.file_content.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        self.test_message = LazyMessage(raw)
+        self.test_message.TO_address = 'fritz_fuchs@bauwagen.de'
+        self.test_message.FROM_address = ('Müller Großhandel Süd Versandabteilung Logistik Handelsgesellschaft mbH '
+                                          '<versand@example.de>')
+        raw = self.test_message.message_as_bytes
+        with self.subTest(test_number=0):
+            # folded with CRLF, smtplib doesn't fix line endings of bytes
+            self.assertNotIn(b'\n', raw.replace(b'\r\n', b''))
+        with self.subTest(test_number=1):
+            from_header = email.message_from_bytes(raw)['From']
+            self.assertIn('\r\n ', from_header)
+            self.assertEqual(email.utils.getaddresses([from_header])[0][1], 'versand@example.de')
+        with self.subTest(test_number=2):
+            # Message creates CRLF line endings as well
+            raw = Message(self.file_content).message_as_bytes
+            self.assertNotIn(b'\n', raw.replace(b'\r\n', b''))
+
+    def test_message_as_bytes_folded(self):
+        raw = (b'From: Paul Positiv\n <paul_positive@example.com>\nTo: a@example.com,\n\tb@example.com\n'
+               b'Subject: folded\n subject\n\nTo: body\n')
+        self.test_message = LazyMessage(raw)
+        self.test_message.TO_address = 'fritz_fuchs@bauwagen.de'
+        self.test_message.FROM_address = 'Jürgen <foo@foobar.com>'
+        self.assertEqual(self.test_message.message_as_bytes,
+                         b'From: =?utf-8?q?J=C3=BCrgen?= <foo@foobar.com>\nTo: fritz_fuchs@bauwagen.de\n'
+                         b'Subject: folded\n subject\n\nTo: body\n')
+
+    def test_header_block(self):
+        self.assertEqual(LazyMessage.header_block(b'To: a@b.de\r\n\r\nbody\r\n\r\n'), b'To: a@b.de\r\n\r\n')
+        self.assertEqual(LazyMessage.header_block(b'To: a@b.de\n\nbody'), b'To: a@b.de\n\n')
+        self.assertEqual(LazyMessage.header_block(b'To: a@b.de\r\n'), b'To: a@b.de\r\n')
+
+
 def main(args=None):
     pass
 